@@ -0,0 +1,76 @@
+#!/bin/python2
+
+# Throughput of metalink.Metafile.scan_file on the given files, with
+# small reads (the block size it used to read), with large reads, with
+# mmap, with a thread per digest and with the pieces hashed by one
+# process per CPU, compared to reading the files without hashing them.
+# Use files which are not in the page cache (or much larger than RAM) to
+# measure disk rather than memory throughput.
+#
+# The cost of building a metalink with many files (as metahumble does
+# for a library) is measured first, as the time per metalink.Metafile.
+#
+# Usage: benchmark.py [FILE...]
+
+import multiprocessing, os, sys, time
+
+import metalink
+
+def raw_read(filename, buffer_size):
+	with open(filename, 'rb', 0) as f:
+		for data, offset, length in metalink.read_blocks(f, buffer_size):
+			pass
+
+def scan(filename, buffer_size, use_mmap, threads = False, processes = 0):
+	f = metalink.Metafile()
+	f.scan_file(filename, True, 255, 256, None, buffer_size, use_mmap, threads, processes)
+	return f.hashes.hashes, f.hashes.pieces
+
+# Add count files with a size, two hashes and two URLs to a metalink,
+# like metahumble.HumbleLinker.run
+def construct(count):
+	m = metalink.Metalink()
+	for i in range(count):
+		m.add_file()
+		m.file.filename = 'file%d.zip' % i
+		m.file.size = str(i)
+		m.file.hashes['sha1'] = '%040x' % i
+		m.file.hashes['md5'] = '%032x' % i
+		m.file.add_url('https://dl.humble.com/file%d.zip?gamekey=x&ttl=1' % i)
+		m.file.add_url('https://dl.humble.com/torrents/file%d.zip.torrent?gamekey=x&ttl=1' % i, 'bittorrent')
+
+def main():
+	count = 20000
+	start = time.time()
+	construct(count)
+	print('%-32s %8.1f us/file' % ('metalink of %d files' % count, (time.time() - start) * 1e6 / count))
+
+	filenames = sys.argv[1:]
+	if not filenames:
+		return
+	total = sum(os.path.getsize(filename) for filename in filenames)
+	big = metalink.scan_buffer_size
+	cpus = multiprocessing.cpu_count()
+
+	methods = [
+		('raw read, %d-byte blocks' % big, lambda filename: raw_read(filename, big)),
+		('scan, 4096-byte reads', lambda filename: scan(filename, 4096, False)),
+		('scan, %d-byte reads' % big, lambda filename: scan(filename, big, False)),
+		('scan, mmap', lambda filename: scan(filename, big, True)),
+		('scan, thread per digest', lambda filename: scan(filename, big, False, True)),
+		('scan, pieces in %d processes' % cpus, lambda filename: scan(filename, big, False, True, cpus)),
+	]
+	results = None
+	for name, method in methods:
+		start = time.time()
+		outputs = [method(filename) for filename in filenames]
+		seconds = time.time() - start
+		print('%-32s %8.1f MB/s' % (name, total / 1e6 / max(seconds, 1e-9)))
+		if outputs[0] is not None:
+			if results is None:
+				results = outputs
+			elif outputs != results:
+				sys.exit('Results of %s differ' % name)
+
+if __name__ == '__main__':
+	main()
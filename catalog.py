@@ -0,0 +1,174 @@
+#!/bin/python2
+
+# SQLite catalog of the library: every order, subproduct, download and
+# download struct seen by the last refresh, so that metalinks, link
+# lists and queries can be produced without talking to the API.
+#
+# The API does not say when an order was made, so orders are dated by
+# the time they were first seen by a refresh of the catalog.
+
+import sqlite3, time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS orders (
+	gamekey TEXT PRIMARY KEY,
+	position INTEGER NOT NULL,
+	machine_name TEXT,
+	human_name TEXT,
+	first_seen REAL NOT NULL,
+	refreshed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS subproducts (
+	id INTEGER PRIMARY KEY,
+	gamekey TEXT NOT NULL REFERENCES orders(gamekey),
+	position INTEGER NOT NULL,
+	machine_name TEXT,
+	human_name TEXT
+);
+CREATE TABLE IF NOT EXISTS downloads (
+	id INTEGER PRIMARY KEY,
+	subproduct_id INTEGER NOT NULL REFERENCES subproducts(id),
+	position INTEGER NOT NULL,
+	machine_name TEXT,
+	platform TEXT
+);
+CREATE TABLE IF NOT EXISTS structs (
+	id INTEGER PRIMARY KEY,
+	download_id INTEGER NOT NULL REFERENCES downloads(id),
+	position INTEGER NOT NULL,
+	name TEXT,
+	filename TEXT,
+	file_size INTEGER,
+	md5 TEXT,
+	sha1 TEXT,
+	web_url TEXT,
+	bittorrent_url TEXT
+);
+CREATE INDEX IF NOT EXISTS orders_position ON orders(position);
+CREATE INDEX IF NOT EXISTS orders_machine_name ON orders(machine_name);
+CREATE INDEX IF NOT EXISTS orders_first_seen ON orders(first_seen);
+CREATE INDEX IF NOT EXISTS subproducts_gamekey ON subproducts(gamekey);
+CREATE INDEX IF NOT EXISTS downloads_subproduct ON downloads(subproduct_id);
+CREATE INDEX IF NOT EXISTS downloads_platform ON downloads(platform);
+CREATE INDEX IF NOT EXISTS structs_download ON structs(download_id);
+CREATE INDEX IF NOT EXISTS structs_filename ON structs(filename);
+CREATE INDEX IF NOT EXISTS structs_file_size ON structs(file_size);
+CREATE INDEX IF NOT EXISTS structs_md5 ON structs(md5);
+'''
+
+def url_filename(url):
+	return url.split("?")[0].split("/")[-1] if url else None
+
+class Catalog(object):
+	def __init__(self, filename):
+		self.db = sqlite3.connect(filename)
+		self.db.executescript(SCHEMA)
+		# MD5 sums are stored in lower case since version 1, so that
+		# lookups can use the index
+		if self.db.execute('PRAGMA user_version').fetchone()[0] < 1:
+			self.db.execute('UPDATE structs SET md5 = lower(md5) WHERE md5 != lower(md5)')
+			self.db.execute('PRAGMA user_version = 1')
+			self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+	def delete(self, gamekey):
+		subproducts = 'SELECT id FROM subproducts WHERE gamekey = ?'
+		downloads = 'SELECT id FROM downloads WHERE subproduct_id IN (%s)' % subproducts
+		self.db.execute('DELETE FROM structs WHERE download_id IN (%s)' % downloads, (gamekey,))
+		self.db.execute('DELETE FROM downloads WHERE subproduct_id IN (%s)' % subproducts, (gamekey,))
+		self.db.execute('DELETE FROM subproducts WHERE gamekey = ?', (gamekey,))
+		self.db.execute('DELETE FROM orders WHERE gamekey = ?', (gamekey,))
+
+	# Replace the catalog entry of an order record (see order_record)
+	def store(self, position, record, now = None):
+		if now is None:
+			now = time.time()
+		gamekey = record['gamekey']
+		row = self.db.execute('SELECT first_seen FROM orders WHERE gamekey = ?', (gamekey,)).fetchone()
+		first_seen = row[0] if row else now
+
+		self.delete(gamekey)
+		self.db.execute('INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?)', (gamekey, position, record['product']['machine_name'], record['product']['human_name'], first_seen, now))
+		for i, subproduct in enumerate(record['subproducts']):
+			subproduct_id = self.db.execute('INSERT INTO subproducts VALUES (NULL, ?, ?, ?, ?)', (gamekey, i, subproduct['machine_name'], subproduct['human_name'])).lastrowid
+			for j, download in enumerate(subproduct['downloads']):
+				download_id = self.db.execute('INSERT INTO downloads VALUES (NULL, ?, ?, ?, ?)', (subproduct_id, j, download['machine_name'], download['platform'])).lastrowid
+				for k, struct in enumerate(download['download_struct']):
+					url = struct['url']
+					self.db.execute('INSERT INTO structs VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (download_id, k, struct['name'], url_filename(url['web']), struct['file_size'], struct['md5'].lower() if struct['md5'] else None, struct['sha1'], url['web'], url['bittorrent']))
+
+	# Store the order records passing through this generator (in library
+	# order), and remove all other orders once they have been consumed
+	def refresh(self, records):
+		now = time.time()
+		gamekeys = set()
+		for position, record in enumerate(records):
+			self.store(position, record, now)
+			gamekeys.add(record['gamekey'])
+			yield record
+		for gamekey, in self.db.execute('SELECT gamekey FROM orders').fetchall():
+			if gamekey not in gamekeys:
+				self.delete(gamekey)
+		self.db.commit()
+
+	# Yield order records (in library order) containing only the download
+	# structs which match all of the given conditions. since and until
+	# are timestamps, compared to the time an order was first seen.
+	def records(self, platform = None, bundle = None, since = None, until = None, min_size = None, md5 = None):
+		conditions = []
+		params = []
+		for condition, value in (
+			('d.platform = ?', platform),
+			('o.machine_name = ?', bundle),
+			('o.first_seen >= ?', since),
+			('o.first_seen < ?', until),
+			('t.file_size >= ?', min_size),
+			('t.md5 = ?', md5.lower() if md5 else None),
+		):
+			if value is not None:
+				conditions.append(condition)
+				params.append(value)
+
+		rows = self.db.execute('''
+			SELECT o.gamekey, o.machine_name, o.human_name, s.id, s.machine_name, s.human_name, d.id, d.machine_name, d.platform,
+				t.name, t.file_size, t.md5, t.sha1, t.web_url, t.bittorrent_url
+			FROM orders o
+			JOIN subproducts s ON s.gamekey = o.gamekey
+			JOIN downloads d ON d.subproduct_id = s.id
+			JOIN structs t ON t.download_id = d.id
+			%s
+			ORDER BY o.position, s.position, d.position, t.position
+		''' % ('WHERE ' + ' AND '.join(conditions) if conditions else ''), params)
+
+		record = subproduct = download = None
+		subproduct_key = download_key = None
+		for row in rows:
+			gamekey, product_machine_name, product_human_name, subproduct_id, subproduct_machine_name, subproduct_human_name, download_id, download_machine_name, platform_name = row[:9]
+			name, file_size, md5_sum, sha1, web_url, bittorrent_url = row[9:]
+			if record is None or record['gamekey'] != gamekey:
+				if record is not None:
+					yield record
+				record = {
+					'gamekey': gamekey,
+					'product': {'machine_name': product_machine_name, 'human_name': product_human_name},
+					'subproducts': [],
+				}
+			if subproduct_key != subproduct_id:
+				subproduct = {'machine_name': subproduct_machine_name, 'human_name': subproduct_human_name, 'downloads': []}
+				record['subproducts'].append(subproduct)
+				subproduct_key = subproduct_id
+			if download_key != download_id:
+				download = {'machine_name': download_machine_name, 'platform': platform_name, 'download_struct': []}
+				subproduct['downloads'].append(download)
+				download_key = download_id
+			download['download_struct'].append({
+				'name': name,
+				'file_size': file_size,
+				'md5': md5_sum,
+				'sha1': sha1,
+				'url': {'web': web_url, 'bittorrent': bittorrent_url},
+			})
+		if record is not None:
+			yield record
@@ -0,0 +1,268 @@
+#!/bin/python2
+
+# Segmented, resumable downloading of the files described by a metalink.
+#
+# Files larger than the segment size are split into byte ranges, which
+# are fetched concurrently (together with the segments of other files)
+# over a shared pool of connections. Progress is recorded next to the
+# partial file, so an interrupted download resumes with the segments
+# that are still missing. The MD5 sum is calculated while the data is
+# being written, so completed files need no second read pass.
+
+import hashlib, json, os, os.path, threading
+
+CHUNK_SIZE = 64 * 1024
+
+class DownloadError(Exception):
+	pass
+
+# MD5 sum of a file whose data arrives out of order. Chunks are hashed
+# as soon as all data before them has been hashed; until then, they are
+# buffered up to limit bytes, after which their writers have to wait.
+# Segments completed by an earlier run are read back from the file.
+class Digest(object):
+	def __init__(self, path, on_disk, limit):
+		self.path = path
+		self.on_disk = on_disk
+		self.limit = limit
+		self.md5 = hashlib.md5()
+		self.offset = 0
+		self.pending = {}
+		self.pending_size = 0
+		self.error = None
+		self.cond = threading.Condition()
+		# Hash the segments at the start of the file which are already
+		# complete, as no writer will ever feed their data
+		with self.cond:
+			self.drain()
+
+	def feed(self, offset, data):
+		with self.cond:
+			while offset != self.offset and self.pending_size + len(data) > self.limit and self.error is None:
+				self.cond.wait()
+			if self.error is not None:
+				raise DownloadError(self.error)
+			if offset < self.offset:
+				return
+			if offset == self.offset:
+				self.md5.update(data)
+				self.offset += len(data)
+				self.drain()
+			else:
+				self.pending[offset] = data
+				self.pending_size += len(data)
+
+	def drain(self):
+		while True:
+			if self.offset in self.pending:
+				data = self.pending.pop(self.offset)
+				self.pending_size -= len(data)
+				self.md5.update(data)
+				self.offset += len(data)
+			elif self.offset in self.on_disk:
+				end = self.on_disk.pop(self.offset)
+				with open(self.path, 'rb') as f:
+					f.seek(self.offset)
+					while self.offset < end:
+						data = f.read(min(1024 * 1024, end - self.offset))
+						if not data:
+							raise DownloadError('%s is truncated' % self.path)
+						self.md5.update(data)
+						self.offset += len(data)
+			else:
+				break
+		self.cond.notify_all()
+
+	def abort(self, error):
+		with self.cond:
+			self.error = error
+			self.cond.notify_all()
+
+	def hexdigest(self):
+		with self.cond:
+			self.drain()
+			return self.md5.hexdigest()
+
+class FileDownload(object):
+	def __init__(self, metafile, directory, segment_size, buffer_size):
+		self.filename = os.path.basename(metafile.filename)
+		self.path = os.path.join(directory, self.filename)
+		self.part = self.path + '.part'
+		self.state_fn = self.part + '.state'
+		self.urls = [res.url for res in metafile.resources if res.type in ('http', 'https')]
+		self.size = int(metafile.size) if metafile.size else None
+		self.md5 = metafile.hashes['md5'].lower() or None
+		self.segment_size = segment_size
+		self.lock = threading.Lock()
+		self.error = None
+
+		if self.size is not None and segment_size and self.size > segment_size:
+			self.segments = [(start, min(start + segment_size, self.size)) for start in xrange(0, self.size, segment_size)]
+			self.ranged = True
+		else:
+			self.segments = [(0, self.size)]
+			self.ranged = False
+
+		self.done = set()
+		if os.path.exists(self.part) and os.path.exists(self.state_fn):
+			with open(self.state_fn) as f:
+				state = json.load(f)
+			if state['size'] == self.size and state['segment_size'] == segment_size and (self.size is None or os.path.getsize(self.part) == self.size):
+				self.done = set(state['done'])
+
+		on_disk = dict(self.segments[index] for index in self.done)
+		self.digest = Digest(self.part, on_disk, buffer_size)
+
+	def is_complete(self):
+		return self.size is not None and os.path.exists(self.path) and os.path.getsize(self.path) == self.size
+
+	def pending_segments(self):
+		return [index for index in range(len(self.segments)) if index not in self.done]
+
+	def open_part(self):
+		with self.lock:
+			if not os.path.exists(self.part):
+				with open(self.part, 'wb') as f:
+					if self.size is not None:
+						f.truncate(self.size)
+		return open(self.part, 'r+b')
+
+	# Record a completed segment; returns True if it was the last one
+	def segment_done(self, index):
+		with self.lock:
+			self.done.add(index)
+			with open(self.state_fn + '.tmp', 'w') as f:
+				json.dump({'size': self.size, 'segment_size': self.segment_size, 'done': sorted(self.done)}, f)
+			os.rename(self.state_fn + '.tmp', self.state_fn)
+			return len(self.done) == len(self.segments)
+
+	def fail(self, error):
+		with self.lock:
+			if self.error is None:
+				self.error = str(error)
+		self.digest.abort(self.error)
+
+	def finish(self):
+		if not os.path.exists(self.part):
+			self.open_part().close()
+		md5 = self.digest.hexdigest()
+		if self.size is not None and self.digest.offset != self.size:
+			raise DownloadError('Only %d of %d bytes could be hashed' % (self.digest.offset, self.size))
+		if self.md5 and md5 != self.md5:
+			# Start over on the next attempt
+			os.remove(self.part)
+			os.remove(self.state_fn)
+			raise DownloadError('Bad md5sum: Expected %s, got %s' % (self.md5, md5))
+		os.rename(self.part, self.path)
+		if os.path.exists(self.state_fn):
+			os.remove(self.state_fn)
+
+class Downloader(object):
+	def __init__(self, session, connections = 8, segment_size = 16 * 1024 * 1024, retries = 3, buffer_size = 32 * 1024 * 1024):
+		self.session = session
+		self.connections = connections
+		self.segment_size = segment_size
+		self.retries = retries
+		self.buffer_size = buffer_size
+
+	# Write the bytes [start, end) of url to the file-like object fp
+	# (positioned at start), passing every chunk to callback(offset,
+	# chunk) after it has been written. end may be None if unknown.
+	def fetch_range(self, url, fp, start, end, ranged = True, callback = None):
+		headers = {}
+		if ranged or start > 0:
+			headers['Range'] = 'bytes=%d-%s' % (start, end - 1 if end is not None else '')
+		response = self.session.get(url, headers=headers, stream=True, timeout=60)
+		try:
+			response.raise_for_status()
+			if headers and response.status_code != 206:
+				raise DownloadError('%s does not support range requests' % url.split("?")[0])
+			pos = start
+			for chunk in response.iter_content(CHUNK_SIZE):
+				if end is not None and pos + len(chunk) > end:
+					chunk = chunk[:end - pos]
+				fp.write(chunk)
+				if callback:
+					callback(pos, chunk)
+				pos += len(chunk)
+				if pos == end:
+					break
+		finally:
+			response.close()
+		if end is not None and pos < end:
+			raise DownloadError('Connection closed after %d of %d bytes' % (pos - start, end - start))
+
+	def fetch_segment(self, download, index):
+		import requests
+		start, end = download.segments[index]
+		# Position up to which the segment has been written, so that a
+		# retry can continue where a failed attempt left off
+		written = [start]
+		def callback(offset, chunk):
+			download.digest.feed(offset, chunk)
+			written[0] = offset + len(chunk)
+
+		error = None
+		for attempt in range(self.retries):
+			if download.error is not None:
+				return download, False
+			url = download.urls[(index + attempt) % len(download.urls)]
+			try:
+				with download.open_part() as f:
+					f.seek(written[0])
+					self.fetch_range(url, f, written[0], end, download.ranged, callback)
+				return download, download.segment_done(index)
+			except (requests.RequestException, DownloadError, IOError) as e:
+				error = e
+		download.fail(error)
+		return download, False
+
+	# Download the files of a metalink.Metalink into directory. Returns
+	# a list of (filename, result) tuples, where result is 'OK' or the
+	# error message.
+	def download_metalink(self, m, directory):
+		from multiprocessing.pool import ThreadPool
+
+		results = {}
+		downloads = []
+		for f in m.files:
+			download = FileDownload(f, directory, self.segment_size, self.buffer_size)
+			if download.is_complete():
+				results[download.filename] = 'OK'
+			elif not download.urls:
+				results[download.filename] = 'No HTTP URL'
+			else:
+				downloads.append(download)
+
+		def finish(download):
+			try:
+				download.finish()
+				results[download.filename] = 'OK'
+			except (DownloadError, IOError, OSError) as e:
+				results[download.filename] = str(e)
+			print(download.filename)
+			print(' >> ' + results[download.filename])
+
+		tasks = []
+		for download in downloads:
+			pending = download.pending_segments()
+			if pending:
+				tasks.extend((download, index) for index in pending)
+			else:
+				finish(download)
+
+		pool = ThreadPool(self.connections)
+		try:
+			for download, complete in pool.imap_unordered(lambda task: self.fetch_segment(*task), tasks):
+				if complete:
+					finish(download)
+		finally:
+			pool.terminate()
+
+		for download in downloads:
+			if download.error is not None:
+				results[download.filename] = download.error
+				print(download.filename)
+				print(' >> ' + download.error)
+
+		return [(os.path.basename(f.filename), results[os.path.basename(f.filename)]) for f in m.files]
@@ -1,67 +1,746 @@
 #!/bin/python2
 
-import os, os.path
+import os, os.path, time
+
+# Plain-data snapshot of the parts of an order that we use
+def order_record(order):
+	record = {
+		'gamekey': order.gamekey,
+		'product': {
+			'machine_name': order.product.machine_name,
+			'human_name': order.product.human_name,
+		},
+		'subproducts': [],
+	}
+	for subproduct in order.subproducts or []:
+		downloads = []
+		for download in subproduct.downloads:
+			structs = []
+			for struct in download.download_struct:
+				structs.append({
+					'name': struct.name,
+					'file_size': struct.file_size,
+					'md5': struct.md5,
+					'sha1': struct.sha1,
+					'url': {'web': struct.url.web, 'bittorrent': struct.url.bittorrent},
+				})
+			downloads.append({
+				'machine_name': download.machine_name,
+				'platform': download.platform,
+				'download_struct': structs,
+			})
+		record['subproducts'].append({
+			'machine_name': subproduct.machine_name,
+			'human_name': subproduct.human_name,
+			'downloads': downloads,
+		})
+	return record
+
+# Download URLs are signed and change on every request, so leave
+# their query strings out of the fingerprint
+def record_fingerprint(record):
+	import copy, hashlib, json
+	record = copy.deepcopy(record)
+	for subproduct in record['subproducts']:
+		for download in subproduct['downloads']:
+			for struct in download['download_struct']:
+				for kind, url in struct['url'].items():
+					if url is not None:
+						struct['url'][kind] = url.split("?")[0]
+	return hashlib.sha1(json.dumps(record, sort_keys=True)).hexdigest()
+
+# Size a requests session's connection pool so that each of the given
+# number of concurrent users can keep its connection alive
+def mount_pool(session, size):
+	import requests.adapters
+	adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+	session.mount('https://', adapter)
+	session.mount('http://', adapter)
+	return session
+
+# Key identifying a download's contents, or None if it has no usable
+# hash. HB-provided SHA1s are less reliable, so prefer the MD5.
+def content_key(struct):
+	if struct['file_size'] is None:
+		return None
+	if struct['md5'] and len(struct['md5']) == 32:
+		return (struct['file_size'], 'md5', struct['md5'].lower())
+	if struct['sha1'] and len(struct['sha1']) == 40:
+		return (struct['file_size'], 'sha1', struct['sha1'].lower())
+	return None
+
+def load_aliases(dl_dir):
+	import json
+	fn = dl_dir + '/hb.aliases'
+	if not os.path.exists(fn):
+		return {}
+	with open(fn) as f:
+		return json.load(f)
+
+# Make the aliases of downloaded files hardlinks to them. Separate
+# copies are only replaced if their contents are identical.
+def link_aliases(dl_dir, aliases):
+	import verifier
+	for filename, names in sorted(aliases.items()):
+		path = os.path.join(dl_dir, filename)
+		if not os.path.exists(path):
+			continue
+		for name in names:
+			alias = os.path.join(dl_dir, name)
+			if os.path.exists(alias):
+				if os.path.samefile(path, alias) or verifier.file_md5(path) != verifier.file_md5(alias):
+					continue
+				os.link(path, alias + '.tmp')
+				os.rename(alias + '.tmp', alias)
+			else:
+				os.link(path, alias)
+
+# Merge the files of a freshly generated metalink into a previously
+# generated one. Entries whose size, hashes and URLs are unchanged are
+# kept as they were loaded; all others are taken from the new metalink.
+# Returns the merged list of files and a dict describing the changes.
+def merge_metalink_files(old, new):
+	def content(f):
+		return (f.size, f.hashes['md5'], f.hashes['sha1'])
+	def urls(f):
+		return [(res.type, res.url) for res in f.resources if res.type not in ('ed2k', 'magnet')]
+
+	old_files = dict((f.filename, f) for f in old.files)
+	new_names = set(f.filename for f in new.files)
+	files = []
+	delta = {'added': [], 'removed': [], 'changed': [], 'refreshed': []}
+	for f in new.files:
+		o = old_files.get(f.filename)
+		if o is None:
+			delta['added'].append(f.filename)
+		elif content(o) != content(f):
+			delta['changed'].append(f.filename)
+		elif urls(o) != urls(f):
+			delta['refreshed'].append(f.filename)
+		else:
+			f = o
+		files.append(f)
+	delta['removed'] = [f.filename for f in old.files if f.filename not in new_names]
+	return files, delta
+
+# An entry of an aria2c input file (see its --input-file option) for a
+# download with the given struct, to be saved as dl_dir/filename.
+# connections maps host names (or None, for all other hosts) to the
+# number of connections to use per server. aria2 has no option for the
+# expected size and no way to use the .torrent of a file next to its
+# web URL, so both are written as comments. Only the MD5 sum is used as
+# checksum, as HB-provided SHA1s are often wrong.
+def aria2_entry(filename, struct, dl_dir, connections = {}):
+	import urlparse
+	url = struct['url']
+	lines = []
+	if struct['file_size'] is not None:
+		lines.append('# size=%d' % struct['file_size'])
+	if url['bittorrent'] is not None:
+		lines.append('# torrent=' + url['bittorrent'])
+	lines.append(url['web'])
+	lines.append(' out=' + filename)
+	lines.append(' dir=' + os.path.abspath(dl_dir))
+	if struct['md5'] and len(struct['md5']) == 32:
+		lines.append(' checksum=md5=' + struct['md5'].lower())
+	host = urlparse.urlparse(url['web']).hostname
+	count = connections.get(host, connections.get(None))
+	if count:
+		lines.append(' max-connection-per-server=%d' % count)
+		lines.append(' split=%d' % count)
+	return ''.join(line + '\n' for line in lines).encode('utf-8')
+
+# A download struct (as in order_record) for a file of a loaded metalink
+def metafile_struct(f):
+	url = {'web': None, 'bittorrent': None}
+	for res in f.resources:
+		if res.type in ('http', 'https') and url['web'] is None:
+			url['web'] = res.url
+		elif res.type == 'bittorrent' and url['bittorrent'] is None:
+			url['bittorrent'] = res.url
+	return {
+		'name': None,
+		'file_size': int(f.size) if f.size else None,
+		'md5': f.hashes['md5'] or None,
+		'sha1': f.hashes['sha1'] or None,
+		'url': url,
+	}
+
+# Merge the metalink.Metalink m with the existing file metalink_fn, if
+# there is one. Returns the delta (see merge_metalink_files) or None.
+def merge_existing(m, metalink_fn):
+	import metalink
+	if not os.path.exists(metalink_fn):
+		return None
+	old = metalink.Metalink(False)
+	old.load_file(metalink_fn, False)
+	m.files, delta = merge_metalink_files(old, m)
+	if m.files:
+		m.rewind()
+	return delta
+
+# Name of the shard that a download of an order record goes to, when
+# sharding by 'bundle', 'platform' or 'both'
+def shard_name(order, download, shard_by):
+	import re
+	names = []
+	if shard_by in ('bundle', 'both'):
+		names.append(order['product']['machine_name'] or 'unknown')
+	if shard_by in ('platform', 'both'):
+		names.append(download['platform'] or 'unknown')
+	return re.sub(r'[^\w.-]', '_', '.'.join(names))
+
+# Fingerprint of the contents of a list of metalink files. As with
+# record_fingerprint, the (expiring) query strings of URLs are ignored,
+# unless full_urls is set.
+def metalink_fingerprint(files, full_urls = False):
+	import hashlib, json
+	sha1 = hashlib.sha1()
+	for f in files:
+		urls = [(res.type, res.url if full_urls else res.url.split("?")[0]) for res in f.resources if res.type not in ('ed2k', 'magnet')]
+		sha1.update(json.dumps([f.filename, f.size, f.os, f.hashes['md5'], f.hashes['sha1'], urls]) + '\n')
+	return sha1.hexdigest()
+
+# Write the metalink.Metalink of every shard in metalinks (a dict keyed
+# by shard name) to DIR/hb.NAME.metalink, and list the shards in
+# DIR/hb.index with their file count, total size and fingerprint.
+# Shards whose contents and URLs (including their signed query strings)
+# did not change are not rewritten. With update, shards are merged with
+# their existing files; returns their deltas. The bytes written are
+# counted in metrics, if given.
+def write_shards(metalinks, dl_dir, update = False, metrics = None):
+	import json, metalink
+
+	index_fn = dl_dir + '/hb.index'
+	old_shards = {}
+	if os.path.exists(index_fn):
+		with open(index_fn) as f:
+			old_shards = dict((shard['name'], shard) for shard in json.load(f)['shards'])
+
+	# Shards which no longer have any files are removed
+	metalinks = dict(metalinks)
+	for name in old_shards:
+		if name not in metalinks:
+			metalinks[name] = metalink.Metalink()
+			metalinks[name].files = []
+
+	shards = []
+	deltas = []
+	written = 0
+	for name in sorted(metalinks):
+		m = metalinks[name]
+		metalink_fn = '%s/hb.%s.metalink' % (dl_dir, name)
+		if update:
+			delta = merge_existing(m, metalink_fn)
+			if delta is None:
+				delta = {'added': [f.filename for f in m.files], 'removed': [], 'changed': [], 'refreshed': []}
+			deltas.append(delta)
+		if not m.files:
+			if os.path.exists(metalink_fn):
+				os.remove(metalink_fn)
+			continue
+		fingerprint = metalink_fingerprint(m.files)
+		url_fingerprint = metalink_fingerprint(m.files, True)
+		old = old_shards.get(name)
+		if old is None or old.get('url_fingerprint') != url_fingerprint or not os.path.exists(metalink_fn):
+			m.generate(metalink_fn)
+			written += 1
+			if metrics is not None:
+				metrics.count('bytes_written', os.path.getsize(metalink_fn))
+		shards.append({
+			'name': name,
+			'metalink': os.path.basename(metalink_fn),
+			'files': len(m.files),
+			'size': sum(int(f.size) for f in m.files if f.size),
+			'fingerprint': fingerprint,
+			'url_fingerprint': url_fingerprint,
+		})
+
+	# Files which merely moved to another shard were neither added nor removed
+	moved = set(sum((delta['added'] for delta in deltas), [])) & set(sum((delta['removed'] for delta in deltas), []))
+	for delta in deltas:
+		for kind in ('added', 'removed'):
+			delta[kind] = [filename for filename in delta[kind] if filename not in moved]
+
+	with open(index_fn + '.tmp', 'w') as f:
+		json.dump({'version': 1, 'shards': shards}, f, indent=1, separators=(',', ': '), sort_keys=True)
+	os.rename(index_fn + '.tmp', index_fn)
+	print('%d of %d shards written' % (written, len(shards)))
+	return deltas
+
+# Load the metalink of a download directory, or the given metalink_fn.
+# By default, this is whichever of DIR/hb.metalink and the shards listed
+# in DIR/hb.index was generated last. A .index file loads all of its
+# shards, or the ones named in shards, into a single metalink.Metalink.
+def load_metalink(dl_dir, metalink_fn = None, shards = None):
+	import json, metalink
+
+	if metalink_fn is None:
+		metalink_fn = dl_dir + '/hb.metalink'
+		index_fn = dl_dir + '/hb.index'
+		if os.path.exists(index_fn) and (not os.path.exists(metalink_fn) or os.path.getmtime(index_fn) > os.path.getmtime(metalink_fn)):
+			metalink_fn = index_fn
+
+	m = metalink.Metalink(False)
+	if not metalink_fn.endswith('.index'):
+		m.load_file(metalink_fn, False)
+		return m
+
+	with open(metalink_fn) as f:
+		index = json.load(f)
+	m.files = []
+	for shard in index['shards']:
+		if shards is None or shard['name'] in shards:
+			part = metalink.Metalink(False)
+			part.load_file(os.path.join(os.path.dirname(metalink_fn), shard['metalink']), False)
+			m.files.extend(part.files)
+	if m.files:
+		m.rewind()
+	return m
+
+class OrderState(object):
+	def __init__(self, filename):
+		self.filename = filename
+		self.orders = {}
+		if os.path.exists(filename):
+			import json
+			with open(filename) as f:
+				self.orders = json.load(f)['orders']
+
+	def is_stale(self, gamekey, max_age = None):
+		if gamekey not in self.orders:
+			return True
+		if max_age is None:
+			return False
+		import time
+		return time.time() - self.orders[gamekey]['fetched'] > max_age
+
+	def get(self, gamekey):
+		return self.orders[gamekey]['order']
+
+	# Return True if the order is new or its contents have changed
+	def update(self, gamekey, record):
+		import time
+		fingerprint = record_fingerprint(record)
+		old = self.orders.get(gamekey)
+		self.orders[gamekey] = {'fetched': time.time(), 'fingerprint': fingerprint, 'order': record}
+		return old is None or old['fingerprint'] != fingerprint
+
+	# Forget orders which are no longer in the library
+	def prune(self, gamekeys):
+		for gamekey in set(self.orders).difference(gamekeys):
+			del self.orders[gamekey]
+
+	def save(self):
+		import json
+		with open(self.filename + '.tmp', 'w') as f:
+			json.dump({'version': 1, 'orders': self.orders}, f)
+		os.rename(self.filename + '.tmp', self.filename)
+
+# Order records fetched by a run which has not completed yet. Records
+# are appended to the file (one JSON object per line, with the time they
+# were fetched) as soon as they have been fetched, so that a restarted
+# run only needs to fetch the rest. The file is removed once the run
+# has written its output.
+class Checkpoint(object):
+	# Age in seconds after which checkpointed records are fetched again,
+	# as the signed URLs of their downloads may have expired
+	max_age = 6 * 60 * 60
+
+	def __init__(self, filename, sync_every = 50):
+		import json, threading
+		self.filename = filename
+		self.sync_every = sync_every
+		self.records = {}
+		self.fetched = {}
+		self.file = None
+		self.unsynced = 0
+		self.lock = threading.Lock()
+
+		if os.path.exists(filename):
+			# Keep the records up to the first incomplete line, which
+			# the interrupted run did not finish writing
+			valid = 0
+			with open(filename, 'rb') as f:
+				for line in f:
+					if not line.endswith('\n'):
+						break
+					try:
+						entry = json.loads(line)
+						record = entry['record']
+					except (ValueError, KeyError):
+						break
+					self.records[record['gamekey']] = record
+					self.fetched[record['gamekey']] = entry['fetched']
+					valid += len(line)
+			if valid != os.path.getsize(filename):
+				with open(filename, 'r+b') as f:
+					f.truncate(valid)
+
+	def add(self, record):
+		import json, time
+		with self.lock:
+			now = time.time()
+			if self.file is None:
+				self.file = open(self.filename, 'ab')
+			self.file.write(json.dumps({'fetched': now, 'record': record}) + '\n')
+			self.file.flush()
+			self.unsynced += 1
+			if self.unsynced >= self.sync_every:
+				os.fsync(self.file.fileno())
+				self.unsynced = 0
+			self.records[record['gamekey']] = record
+			self.fetched[record['gamekey']] = now
+
+	# Gamekeys of the records fetched less than max_age seconds (and
+	# less than Checkpoint.max_age) ago, whose signed URLs are still usable
+	def fresh(self, max_age = None):
+		import time
+		if max_age is None or max_age > self.max_age:
+			max_age = self.max_age
+		return set(gamekey for gamekey, fetched in self.fetched.items() if time.time() - fetched < max_age)
+
+	def remove(self):
+		with self.lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+			if os.path.exists(self.filename):
+				os.remove(self.filename)
+
+# On-disk cache of order records, with one JSON file per gamekey.
+# Entries expire ttl seconds after being stored; once the cache grows
+# beyond max_size bytes, the least recently used entries are evicted.
+class OrderCache(object):
+	def __init__(self, directory, ttl, max_size):
+		import threading
+		self.directory = directory
+		self.ttl = ttl
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		self.size = sum(os.path.getsize(path) for path in self.entries())
+		self.evict()
+
+	def entries(self):
+		import glob
+		return glob.glob(os.path.join(self.directory, '*.json'))
+
+	def path(self, gamekey):
+		return os.path.join(self.directory, gamekey + '.json')
+
+	def get(self, gamekey):
+		import json, time
+		path = self.path(gamekey)
+		with self.lock:
+			try:
+				with open(path) as f:
+					entry = json.load(f)
+			except (IOError, ValueError):
+				entry = None
+			if entry is not None and time.time() - entry['stored'] > self.ttl:
+				self.remove(path)
+				entry = None
+
+			if entry is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			# The modification time records when the entry was last used
+			os.utime(path, None)
+			return entry['order']
+
+	def put(self, gamekey, record):
+		import json, time
+		path = self.path(gamekey)
+		with self.lock:
+			if os.path.exists(path):
+				self.remove(path)
+			with open(path + '.tmp', 'w') as f:
+				json.dump({'stored': time.time(), 'order': record}, f)
+			os.rename(path + '.tmp', path)
+			self.size += os.path.getsize(path)
+			self.evict(path)
+
+	# Remove least recently used entries until the cache fits max_size
+	def evict(self, keep = None):
+		if self.size <= self.max_size:
+			return
+		for path in sorted(self.entries(), key=os.path.getmtime):
+			if self.size <= self.max_size:
+				break
+			if path != keep:
+				self.remove(path)
+				self.evictions += 1
+
+	def remove(self, path):
+		self.size -= os.path.getsize(path)
+		os.remove(path)
+
+	# Print the cache statistics and add them to a metrics.Metrics
+	def report(self, metrics):
+		print('Order cache: %d hits, %d misses, %d evictions' % (self.hits, self.misses, self.evictions))
+		metrics.count('order_cache_hits', self.hits)
+		metrics.count('order_cache_misses', self.misses)
+		metrics.count('order_cache_evictions', self.evictions)
+		if self.hits + self.misses:
+			metrics.set('order_cache_hit_ratio', float(self.hits) / (self.hits + self.misses))
+
+# Order records shared by the accounts of run_accounts. The first
+# account asking for a gamekey fetches its order, and the accounts
+# asking for it in the meantime wait for the result, so that an order
+# owned by several accounts is only fetched once.
+class SharedRecords(object):
+	def __init__(self):
+		import threading
+		self.records = {}
+		# Events of the gamekeys which are being fetched
+		self.pending = {}
+		self.lock = threading.Lock()
+
+	# Return the record of gamekey, calling fetch(gamekey) unless another
+	# account has fetched it or is fetching it. If that fetch fails, the
+	# waiting accounts try again themselves.
+	def get(self, gamekey, fetch):
+		import threading
+		while True:
+			with self.lock:
+				if gamekey in self.records:
+					return self.records[gamekey]
+				event = self.pending.get(gamekey)
+				if event is None:
+					event = self.pending[gamekey] = threading.Event()
+					break
+			event.wait()
+
+		try:
+			record = fetch(gamekey)
+			with self.lock:
+				self.records[gamekey] = record
+			return record
+		finally:
+			with self.lock:
+				del self.pending[gamekey]
+			event.set()
 
 class HumbleLinker(object):
 	def __init__(self):
-		self.cache = False
+		import metrics
+		self.cache = None
+		self.metrics = metrics.Metrics()
+		# A ratelimit.Throttle for API calls, created by collect if not set
+		self.throttle = None
+		# A SharedRecords, set by run_accounts to share orders between accounts
+		self.shared_records = None
 
-	def enable_cache(self):
-		import requests_cache
-		requests_cache.install_cache('web_cache')
-		self.cache = True
+	def enable_cache(self, directory = 'order_cache', ttl = 6 * 60 * 60, max_size = 100 * 1024 * 1024):
+		self.cache = OrderCache(directory, ttl, max_size)
 
 	def login(self, username, password):
 		import humblebundle
 		self.client = humblebundle.HumbleApi()
 
-		self.client.login(username, password)
+		with self.metrics.phase('login'):
+			self.client.login(username, password)
+
+	def get_order(self, gamekey):
+		def attempt():
+			self.metrics.count('get_order_requests')
+			try:
+				with self.metrics.timer('get_order_seconds'):
+					return self.client.get_order(gamekey)
+			except Exception:
+				self.metrics.count('get_order_errors')
+				raise
+		return self.throttle.call(attempt)
+
+	def get_record(self, gamekey):
+		if self.shared_records is not None:
+			return self.shared_records.get(gamekey, self.load_record)
+		return self.load_record(gamekey)
+
+	def load_record(self, gamekey):
+		if self.cache is not None:
+			record = self.cache.get(gamekey)
+			if record is not None:
+				return record
 
-	def run(self, dl_dir = 'dl', platform = None, links_fn = None, btlinks_fn = None, get_torrents = False):
+		record = order_record(self.get_order(gamekey))
+		if self.cache is not None:
+			self.cache.put(gamekey, record)
+		return record
+
+	# Yield the records of gamekeys in order. Records are added to
+	# checkpoint, if given, as soon as they have been fetched.
+	def fetch_records(self, gamekeys, jobs = 1, checkpoint = None):
+		def fetch(gamekey):
+			record = self.get_record(gamekey)
+			if checkpoint is not None:
+				checkpoint.add(record)
+			return record
+
+		if jobs <= 1:
+			for gamekey in gamekeys:
+				yield fetch(gamekey)
+			return
+
+		mount_pool(self.client.session, jobs)
+
+		# imap yields results in submission order, so the output is
+		# identical to that of a sequential run
+		from multiprocessing.pool import ThreadPool
+		pool = ThreadPool(jobs)
+		try:
+			for record in pool.imap(fetch, gamekeys):
+				yield record
+		finally:
+			pool.terminate()
+
+	# Yield order records in gamekey order, fetching the orders listed
+	# in fetch (unless an interrupted run already recorded them in the
+	# checkpoint less than max_age seconds ago) and taking all others
+	# from the state store
+	def get_records(self, gamekeys, fetch, jobs = 1, state = None, checkpoint = None, max_age = None):
+		resumed = checkpoint.fresh(max_age).intersection(fetch) if checkpoint is not None else set()
+		records = self.fetch_records([gamekey for gamekey in fetch if gamekey not in resumed], jobs, checkpoint)
+		fetch = set(fetch)
+
+		for gamekey in gamekeys:
+			if gamekey in resumed:
+				record = checkpoint.records[gamekey]
+			elif gamekey in fetch:
+				record = next(records)
+			else:
+				yield state.get(gamekey)
+				continue
+			if state is not None and state.update(gamekey, record):
+				self.changed_orders += 1
+			yield record
+
+	# Download (url, filename) pairs of .torrent files. Existing files
+	# are only replaced if the server reports them as modified since.
+	def fetch_torrents(self, torrents, jobs = 4):
+		import email.utils, requests
+		from multiprocessing.pool import ThreadPool
+		session = mount_pool(requests.Session(), jobs)
+
+		def fetch(torrent):
+			url, filename = torrent
+			headers = {}
+			if os.path.exists(filename):
+				headers['If-Modified-Since'] = email.utils.formatdate(os.path.getmtime(filename), usegmt=True)
+			try:
+				self.metrics.count('torrent_requests')
+				with self.metrics.timer('torrent_seconds'):
+					response = session.get(url, headers=headers, timeout=30)
+				if response.status_code == requests.codes.not_modified:
+					return 'unchanged'
+				response.raise_for_status()
+				with open(filename + '.tmp', 'wb') as f:
+					f.write(response.content)
+				os.rename(filename + '.tmp', filename)
+				self.metrics.count('bytes_written', len(response.content))
+			except (requests.RequestException, IOError, OSError) as e:
+				self.metrics.count('torrent_errors')
+				print('Failed to download %s: %s' % (filename, e))
+				return 'failed'
+
+			last_modified = email.utils.parsedate_tz(response.headers.get('Last-Modified', ''))
+			if last_modified:
+				mtime = email.utils.mktime_tz(last_modified)
+				os.utime(filename, (mtime, mtime))
+			return 'downloaded'
+
+		pool = ThreadPool(jobs)
+		try:
+			with self.metrics.phase('torrents'):
+				results = pool.map(fetch, torrents)
+		finally:
+			pool.terminate()
+		print('Torrents: %d downloaded, %d unchanged, %d failed' % tuple(results.count(result) for result in ('downloaded', 'unchanged', 'failed')))
+
+	# Fetch the order records of the account. Returns the gamekeys and
+	# a generator of their records; orders recorded in state are only
+	# fetched once they are older than max_age, and orders recorded in
+	# checkpoint are not fetched again unless they are older than max_age.
+	def collect(self, jobs = 1, state = None, max_age = None, checkpoint = None):
+		if self.throttle is None:
+			import ratelimit
+			self.throttle = ratelimit.Throttle(jobs)
+		gamekeys = self.throttle.call(self.client.get_gamekeys)
+
+		if state is not None:
+			fetch = [gamekey for gamekey in gamekeys if state.is_stale(gamekey, max_age)]
+		else:
+			fetch = gamekeys
+		self.fetched = len(fetch)
+		self.changed_orders = 0
+
+		if checkpoint is not None and checkpoint.records:
+			print('Resuming an interrupted run: %d of %d orders already fetched' % (len(checkpoint.fresh(max_age).intersection(fetch)), len(fetch)))
+
+		return gamekeys, self.get_records(gamekeys, fetch, jobs, state, checkpoint, max_age)
+
+	# Write the metalink (and link lists and aliases) for the given order
+	# records to dl_dir, or one metalink per shard if shard_by is set.
+	# Returns the (url, filename) pairs of the .torrent files to download.
+	def write(self, records, dl_dir = 'dl', platform = None, links_fn = None, btlinks_fn = None, get_torrents = False, update = False, delta_fn = None, dedup = False, shard_by = None, aria2_fn = None, aria2_connections = {}):
 		links = open(links_fn, 'w') if links_fn else None
 		btlinks = open(btlinks_fn, 'w') if btlinks_fn else None
+		aria2 = open(aria2_fn, 'w') if aria2_fn else None
 
 		if not os.path.exists(dl_dir):
 			os.makedirs(dl_dir)
 
 		import metalink
 
-		m = metalink.Metalink()
-		m.files = []
+		def new_metalink():
+			m = metalink.Metalink()
+			m.files = []
+			return m
 		metalink._opts['overwrite'] = True
 		metalink._opts['create_torrent'] = False
 
+		metalinks = {}
 		files = set()
+		contents = {}
+		aliases = {}
+		torrents = []
+		torrent_files = set()
 
-		import progressbar
-		progress = progressbar.ProgressBar()
-
-		for gamekey in progress(self.client.get_gamekeys()):
-			order = self.client.get_order(gamekey)
-			#print(order.product.machine_name)
-			if order.subproducts is not None:
-				for subproduct in order.subproducts:
+		start = time.time()
+		for order in records:
+			self.metrics.count('orders')
+			#print(order['product']['machine_name'])
+			if order['subproducts']:
+				for subproduct in order['subproducts']:
 					#print(subproduct)
-					#print(" " + subproduct.machine_name)
-					for download in subproduct.downloads:
-						#print download.platform
-						if platform is None or platform == download.platform:
-							for struct in download.download_struct:
+					#print(" " + subproduct['machine_name'])
+					for download in subproduct['downloads']:
+						#print download['platform']
+						if platform is None or platform == download['platform']:
+							for struct in download['download_struct']:
+								url = struct['url']
 								found_link = False
-								if struct.url.bittorrent is not None:
+								if url['bittorrent'] is not None:
 									found_link = True
 									if btlinks:
-										btlinks.write(struct.url.bittorrent + '\n')
+										btlinks.write(url['bittorrent'] + '\n')
 
-									torrent_fn = dl_dir + '/' + struct.url.bittorrent.split("?")[0].split("/")[-1]
-									if get_torrents and not os.path.exists(torrent_fn):
-										import urllib
-										urllib.urlretrieve(struct.url.bittorrent, torrent_fn)
+									torrent_fn = dl_dir + '/' + url['bittorrent'].split("?")[0].split("/")[-1]
+									if get_torrents and torrent_fn not in torrent_files:
+										torrent_files.add(torrent_fn)
+										torrents.append((url['bittorrent'], torrent_fn))
 
-								if struct.url.web is not None:
+								if url['web'] is not None:
 									found_link = True
 									if links:
-										links.write(struct.url.web + '\n')
+										links.write(url['web'] + '\n')
 
 								if not found_link:
 									#print(subproduct)
@@ -70,47 +749,453 @@ class HumbleLinker(object):
 									#print('----------------')
 									continue
 
-								filename = struct.url.web.split("?")[0].split("/")[-1]
+								filename = url['web'].split("?")[0].split("/")[-1]
 								if filename in files:
 									continue
 								files.add(filename)
 
+								# Record identical downloads as aliases of the first one
+								key = content_key(struct) if dedup else None
+								if key is not None:
+									if key in contents:
+										aliases.setdefault(contents[key], []).append(filename)
+										continue
+									contents[key] = filename
+
+								shard = shard_name(order, download, shard_by) if shard_by else None
+								if shard not in metalinks:
+									metalinks[shard] = new_metalink()
+								m = metalinks[shard]
 								m.add_file()
 								m.file.filename = filename
-								m.file.os = download.platform
-								if struct.file_size is not None:
-									m.file.size = str(struct.file_size)
-								if struct.sha1 and len(struct.sha1) == 40:
-									m.file.hashes['sha1'] = struct.sha1
-								if struct.md5 and len(struct.md5) == 32:
-									m.file.hashes['md5'] = struct.md5
-								if struct.url.web is not None:
-									m.file.add_url(struct.url.web)
-								if struct.url.bittorrent is not None:
-									m.file.add_url(struct.url.bittorrent, 'bittorrent')
-
-		m.generate(dl_dir + '/hb.metalink')
+								m.file.os = download['platform']
+								if struct['file_size'] is not None:
+									m.file.size = str(struct['file_size'])
+								if struct['sha1'] and len(struct['sha1']) == 40:
+									m.file.hashes['sha1'] = struct['sha1']
+								if struct['md5'] and len(struct['md5']) == 32:
+									m.file.hashes['md5'] = struct['md5']
+								if url['web'] is not None:
+									m.file.add_url(url['web'])
+								if url['bittorrent'] is not None:
+									m.file.add_url(url['bittorrent'], 'bittorrent')
+								if aria2:
+									aria2.write(aria2_entry(filename, struct, dl_dir, aria2_connections))
 
-def main():
+		self.metrics.add_phase('orders', time.time() - start)
+		start = time.time()
+
+		for f in (links, btlinks, aria2):
+			if f:
+				f.close()
+				self.metrics.count('bytes_written', os.path.getsize(f.name))
+
+		if shard_by:
+			deltas = write_shards(metalinks, dl_dir, update, self.metrics)
+		else:
+			metalink_fn = dl_dir + '/hb.metalink'
+			m = metalinks.get(None) or new_metalink()
+			deltas = [merge_existing(m, metalink_fn)] if update else []
+			m.generate(metalink_fn)
+			self.metrics.count('bytes_written', os.path.getsize(metalink_fn))
+		self.metrics.set('files', sum(len(m.files) for m in metalinks.values()))
+
+		deltas = [delta for delta in deltas if delta is not None]
+		if deltas:
+			delta = dict((kind, sum((delta[kind] for delta in deltas), [])) for kind in ('added', 'removed', 'changed', 'refreshed'))
+			print('Metalink update: %s' % ', '.join('%d %s' % (len(delta[kind]), kind) for kind in ('added', 'removed', 'changed', 'refreshed')))
+			if delta_fn:
+				import json
+				with open(delta_fn, 'w') as f:
+					json.dump(delta, f, indent=1, separators=(',', ': '), sort_keys=True)
+
+		if dedup:
+			import json
+			with open(dl_dir + '/hb.aliases', 'w') as f:
+				json.dump(aliases, f, indent=1, separators=(',', ': '), sort_keys=True)
+			print('%d duplicate files recorded as aliases' % sum(len(names) for names in aliases.values()))
+			self.metrics.count('bytes_written', os.path.getsize(dl_dir + '/hb.aliases'))
+			link_aliases(dl_dir, aliases)
+
+		self.metrics.add_phase('metalink', time.time() - start)
+		return torrents
+
+	def run(self, dl_dir = 'dl', platform = None, links_fn = None, btlinks_fn = None, get_torrents = False, jobs = 1, sync = False, max_age = None, torrent_jobs = 4, update = False, delta_fn = None, dedup = False, shard_by = None, aria2_fn = None, aria2_connections = {}, catalog_fn = None):
+		if not os.path.exists(dl_dir):
+			os.makedirs(dl_dir)
+
+		state = OrderState(dl_dir + '/hb.state') if sync else None
+		checkpoint = Checkpoint(dl_dir + '/hb.checkpoint')
+		gamekeys, records = self.collect(jobs, state, max_age, checkpoint)
+
+		if catalog_fn:
+			import catalog
+			records = catalog.Catalog(catalog_fn).refresh(records)
+
+		import progressbar
+		progress = progressbar.ProgressBar(maxval=len(gamekeys))
+
+		torrents = self.write(progress(records), dl_dir, platform, links_fn, btlinks_fn, get_torrents, update, delta_fn, dedup, shard_by, aria2_fn, aria2_connections)
+
+		if state is not None:
+			state.prune(gamekeys)
+			state.save()
+			print('%d of %d orders fetched, %d new or changed' % (self.fetched, len(gamekeys), self.changed_orders))
+		checkpoint.remove()
+		if self.cache is not None:
+			self.cache.report(self.metrics)
+
+		if torrents:
+			self.fetch_torrents(torrents, torrent_jobs)
+
+# Read a credentials file with one "email password" pair per line.
+# Raises ValueError for lines without a password.
+def read_accounts(filename):
+	accounts = []
+	with open(filename) as f:
+		for number, line in enumerate(f, 1):
+			line = line.strip()
+			if line and not line.startswith('#'):
+				fields = line.split(None, 1)
+				if len(fields) != 2:
+					raise ValueError('%s:%d: expected "email password"' % (filename, number))
+				accounts.append(tuple(fields))
+	return accounts
+
+# Process several accounts at once. Up to jobs accounts log in and fetch
+# their orders concurrently, sharing one ratelimit.Throttle (by default, one
+# allowing up to jobs calls at a time), the order cache and the orders
+# owned by more than one account. With merge, the downloads of all
+# accounts are described by a single metalink in dl_dir (so that files
+# bought by several accounts appear once); otherwise, every account
+# gets a metalink in its own subdirectory, named after its email.
+# Metrics of all accounts are collected in metrics, if given, and the
+# orders of all accounts are stored in the catalog catalog_fn, if given.
+def run_accounts(accounts, dl_dir = 'dl', merge = False, platform = None, links_fn = None, btlinks_fn = None, get_torrents = False, jobs = 1, sync = False, max_age = None, torrent_jobs = 4, update = False, delta_fn = None, dedup = False, cache = None, shard_by = None, metrics = None, throttle = None, aria2_fn = None, aria2_connections = {}, catalog_fn = None):
+	import itertools
+	from multiprocessing.pool import ThreadPool
+
+	if not accounts:
+		raise ValueError('No accounts given')
+	if metrics is None:
+		import metrics as metrics_module
+		metrics = metrics_module.Metrics()
+	if throttle is None:
+		import ratelimit
+		throttle = ratelimit.Throttle(jobs)
+	shared_records = SharedRecords()
+
+	if merge:
+		dirs = [dl_dir for account in accounts]
+	else:
+		dirs = [os.path.join(dl_dir, email) for email, password in accounts]
+
+	states = {}
+	checkpoints = {}
+	for directory in dirs:
+		if directory not in checkpoints:
+			if not os.path.exists(directory):
+				os.makedirs(directory)
+			checkpoints[directory] = Checkpoint(directory + '/hb.checkpoint')
+			if sync:
+				states[directory] = OrderState(directory + '/hb.state')
+
+	def collect(task):
+		(email, password), directory = task
+		linker = HumbleLinker()
+		linker.cache = cache
+		linker.throttle = throttle
+		linker.shared_records = shared_records
+		linker.metrics = metrics
+		linker.login(email, password)
+		gamekeys, records = linker.collect(jobs, states.get(directory), max_age, checkpoints[directory])
+		with metrics.phase('orders'):
+			records = list(records)
+		print('%s: %d orders, %d fetched, %d new or changed' % (email, len(gamekeys), linker.fetched, linker.changed_orders))
+		return linker, gamekeys, records
+
+	pool = ThreadPool(max(1, min(len(accounts), jobs)))
+	try:
+		results = pool.map(collect, zip(accounts, dirs))
+	finally:
+		pool.terminate()
+
+	if catalog_fn:
+		import catalog
+		for record in catalog.Catalog(catalog_fn).refresh(itertools.chain(*[records for _, _, records in results])):
+			pass
+
+	linker = results[0][0]
+	if merge:
+		records = itertools.chain(*[records for _, _, records in results])
+		torrents = linker.write(records, dl_dir, platform, links_fn, btlinks_fn, get_torrents, update, delta_fn, dedup, shard_by, aria2_fn, aria2_connections)
+	else:
+		torrents = []
+		for (email, password), directory, (_, _, records) in zip(accounts, dirs, results):
+			print(email)
+			torrents += linker.write(records, directory, platform, None, None, get_torrents, update, None, dedup, shard_by)
+
+	for directory, state in states.items():
+		gamekeys = set()
+		for result_dir, (_, result_gamekeys, _) in zip(dirs, results):
+			if result_dir == directory:
+				gamekeys.update(result_gamekeys)
+		state.prune(gamekeys)
+		state.save()
+	for checkpoint in checkpoints.values():
+		checkpoint.remove()
+	if cache is not None:
+		cache.report(metrics)
+
+	# Download every .torrent file once, and hard-link it into the
+	# directories of the other accounts that need it
+	copies = {}
+	for url, filename in torrents:
+		copies.setdefault(os.path.basename(filename), []).append((url, filename))
+	if copies:
+		linker.fetch_torrents([paths[0] for paths in copies.values()], torrent_jobs)
+	for paths in copies.values():
+		source = paths[0][1]
+		for url, filename in paths[1:]:
+			if os.path.exists(source) and not (os.path.exists(filename) and os.path.samefile(source, filename)):
+				os.link(source, filename + '.tmp')
+				os.rename(filename + '.tmp', filename)
+
+def download_main(argv):
+	import argparse, sys
+	import downloader, requests
+
+	parser = argparse.ArgumentParser(prog='metahumble.py download', description='Download the files described by a generated metalink')
+	parser.add_argument('--dir', default='dl', help='target download directory (default: dl)')
+	parser.add_argument('--metalink', metavar='FILE', help='metalink or shard index to download (default: DIR/hb.metalink or DIR/hb.index)')
+	parser.add_argument('--shard', metavar='NAME', action='append', help='only download the files of this shard of the index (may be repeated)')
+	parser.add_argument('--connections', metavar='N', type=int, default=8, help='number of concurrent connections (default: 8)')
+	parser.add_argument('--segment-size', metavar='MB', type=float, default=16, help='split files into byte ranges of this size, 0 to disable (default: 16)', dest='segment_size')
+
+	args = parser.parse_args(argv)
+
+	m = load_metalink(args.dir, args.metalink, args.shard)
+
+	d = downloader.Downloader(mount_pool(requests.Session(), args.connections), args.connections, int(args.segment_size * 1024 * 1024))
+	results = d.download_metalink(m, args.dir)
+	link_aliases(args.dir, load_aliases(args.dir))
+	failed = [fn for fn, result in results if result != 'OK']
+	print('%d of %d files downloaded' % (len(results) - len(failed), len(results)))
+	sys.exit(1 if failed else 0)
+
+def verify_main(argv):
+	import argparse, sys
+	import verifier
+
+	parser = argparse.ArgumentParser(prog='metahumble.py verify', description='Verify downloaded files against a generated metalink. Bad files are moved to DIR/old/DATE/bad, files not in the metalink to DIR/old/DATE/unknown.')
+	parser.add_argument('--dir', default='dl', help='download directory (default: dl)')
+	parser.add_argument('--metalink', metavar='FILE', help='metalink or shard index to verify against (default: DIR/hb.metalink or DIR/hb.index)')
+	parser.add_argument('--size-only', action='store_true', help='only check file sizes, not MD5 sums', dest='size_only')
+	parser.add_argument('--jobs', metavar='N', type=int, help='number of files to hash concurrently (default: number of CPUs)')
+	parser.add_argument('--disk-jobs', metavar='N', type=int, default=1, help='number of files to hash concurrently on one disk (default: 1)', dest='disk_jobs')
+
+	args = parser.parse_args(argv)
+
+	m = load_metalink(args.dir, args.metalink)
+
+	bad = verifier.verify(m, args.dir, not args.size_only, args.jobs, load_aliases(args.dir), args.disk_jobs)
+	sys.exit(1 if bad else 0)
+
+def catalog_main(argv):
+	import argparse, time
+	import catalog
+
+	def date(value):
+		try:
+			return time.mktime(time.strptime(value, '%Y-%m-%d'))
+		except ValueError:
+			raise argparse.ArgumentTypeError('invalid date (expected YYYY-MM-DD): %s' % value)
+
+	parser = argparse.ArgumentParser(prog='metahumble.py catalog', description='Generate a metalink and link lists from the library catalog (stored by metahumble.py --catalog FILE), or list the files matching a query, without contacting humblebundle.com. Orders are dated by when they were first stored in the catalog.')
+	parser.add_argument('--catalog', metavar='FILE', required=True, help='SQLite catalog to use')
+	parser.add_argument('--dir', default='dl', help='target download directory (default: dl)')
+	parser.add_argument('--platform', help='only include downloads for a certain platform (e.g.: android)')
+	parser.add_argument('--bundle', metavar='NAME', help='only include orders of the bundle with this machine name')
+	parser.add_argument('--since', metavar='DATE', type=date, help='only include orders first seen on or after DATE (YYYY-MM-DD)')
+	parser.add_argument('--until', metavar='DATE', type=date, help='only include orders first seen before DATE (YYYY-MM-DD)')
+	parser.add_argument('--min-size', metavar='MB', type=float, help='only include files of at least MB megabytes', dest='min_size')
+	parser.add_argument('--md5', metavar='HASH', help='only include files with this MD5 sum')
+	parser.add_argument('--list', action='store_true', help='list the matching files (bundle, platform, name, size and MD5 sum) instead of writing a metalink')
+	parser.add_argument('--save-links', metavar='FILE', help='save http/https links to given text file', dest='links')
+	parser.add_argument('--save-bt-links', metavar='FILE', help='save bittorrent links to given text file', dest='btlinks')
+	parser.add_argument('--save-aria2', metavar='FILE', help='save downloads to given aria2c input file', dest='aria2')
+	parser.add_argument('--dedup', action='store_true', help='describe downloads with identical contents only once (see metahumble.py --help)')
+	parser.add_argument('--shard', choices=('bundle', 'platform', 'both'), help='write one metalink per bundle and/or platform (see metahumble.py --help)', dest='shard_by')
+
+	args = parser.parse_args(argv)
+
+	library = catalog.Catalog(args.catalog)
+	min_size = int(args.min_size * 1024 * 1024) if args.min_size is not None else None
+	records = library.records(args.platform, args.bundle, args.since, args.until, min_size, args.md5)
+
+	if args.list:
+		for record in records:
+			for subproduct in record['subproducts']:
+				for download in subproduct['downloads']:
+					for struct in download['download_struct']:
+						print(u'\t'.join([record['product']['human_name'] or '', download['platform'] or '', catalog.url_filename(struct['url']['web']) or '', str(struct['file_size']) if struct['file_size'] is not None else '', struct['md5'] or '']).encode('utf-8'))
+		return
+
+	HumbleLinker().write(records, args.dir, args.platform, args.links, args.btlinks, False, False, None, args.dedup, args.shard_by, args.aria2)
+
+def plan_main(argv):
 	import argparse
+	import metalink, planner
+
+	parser = argparse.ArgumentParser(prog='metahumble.py plan', description='List the files of a generated metalink which are missing from DIR, truncated or different, and optionally save them as a metalink or aria2c input file for downloading. Files of the right size are hashed unless DIR/hb.verified shows that they have not changed since they were last hashed.')
+	parser.add_argument('--dir', default='dl', help='download directory (default: dl)')
+	parser.add_argument('--metalink', metavar='FILE', help='metalink or shard index to compare with (default: DIR/hb.metalink or DIR/hb.index)')
+	parser.add_argument('--size-only', action='store_true', help='only compare file sizes, not MD5 sums', dest='size_only')
+	parser.add_argument('--jobs', metavar='N', type=int, help='number of files to hash concurrently (default: number of CPUs)')
+	parser.add_argument('--save-metalink', metavar='FILE', help='save the files to download to given metalink', dest='save_metalink')
+	parser.add_argument('--save-aria2', metavar='FILE', help='save the files to download to given aria2c input file', dest='aria2')
+	parser.add_argument('--aria2-connections', metavar='N', type=int, help='with --save-aria2, use N connections per server', dest='aria2_connections')
+
+	args = parser.parse_args(argv)
 
-	parser = argparse.ArgumentParser(description='HumbleBundle Metalink generator')
-	parser.add_argument('email', help='humblebundle.com login (email address)')
-	parser.add_argument('password', help='humblebundle.com password')
-	parser.add_argument('--cache', action='store_true', help='cache web requests')
+	m = load_metalink(args.dir, args.metalink)
+	work = planner.plan(m, args.dir, not args.size_only, args.jobs)
+
+	totals = {}
+	for f, status in work:
+		print(os.path.basename(f.filename))
+		print(' >> ' + status.capitalize())
+		count, size = totals.get(status, (0, 0))
+		totals[status] = (count + 1, size + (int(f.size) if f.size else 0))
+	summary = []
+	for status in ('missing', 'truncated', 'changed'):
+		count, size = totals.get(status, (0, 0))
+		summary.append('%d %s (%d bytes)' % (count, status, size))
+	print('%s; %d of %d files (%d bytes) to download' % (', '.join(summary), len(work), len(m.files), sum(size for count, size in totals.values())))
+
+	if args.save_metalink:
+		metalink._opts['overwrite'] = True
+		metalink._opts['create_torrent'] = False
+		plan_m = metalink.Metalink()
+		plan_m.files = [f for f, status in work]
+		if plan_m.files:
+			plan_m.rewind()
+		plan_m.generate(args.save_metalink)
+	if args.aria2:
+		connections = {None: args.aria2_connections} if args.aria2_connections else {}
+		with open(args.aria2, 'w') as out:
+			for f, status in work:
+				out.write(aria2_entry(os.path.basename(f.filename), metafile_struct(f), args.dir, connections))
+
+def repair_main(argv):
+	import argparse, sys
+	import downloader, repair, requests
+
+	parser = argparse.ArgumentParser(prog='metahumble.py repair', description='Check the pieces of downloaded files against the piece hashes of a metalink (as written by metalink.py or taken from a torrent), and fetch the byte ranges of bad pieces again. Files without piece hashes are skipped.')
+	parser.add_argument('--dir', default='dl', help='download directory (default: dl)')
+	parser.add_argument('--metalink', metavar='FILE', help='metalink or shard index to check against (default: DIR/hb.metalink or DIR/hb.index)')
+	parser.add_argument('--check', action='store_true', help='only report the bad byte ranges, do not repair them')
+	parser.add_argument('--jobs', metavar='N', type=int, help='number of processes hashing pieces (default: number of CPUs)')
+
+	args = parser.parse_args(argv)
+
+	m = load_metalink(args.dir, args.metalink)
+
+	d = None if args.check else downloader.Downloader(mount_pool(requests.Session(), 1), 1)
+	failed = repair.repair(m, args.dir, d, args.jobs)
+	sys.exit(1 if failed else 0)
+
+commands = {
+	'catalog': catalog_main,
+	'download': download_main,
+	'plan': plan_main,
+	'repair': repair_main,
+	'verify': verify_main,
+}
+
+def main():
+	import argparse, sys
+
+	if len(sys.argv) > 1 and sys.argv[1] in commands:
+		return commands[sys.argv[1]](sys.argv[2:])
+
+	parser = argparse.ArgumentParser(description='HumbleBundle Metalink generator', epilog='other commands: %s (see metahumble.py COMMAND --help)' % ', '.join(sorted(commands)))
+	parser.add_argument('email', nargs='?', help='humblebundle.com login (email address)')
+	parser.add_argument('password', nargs='?', help='humblebundle.com password')
+	parser.add_argument('--accounts', metavar='FILE', help='process all accounts listed in FILE (one "email password" pair per line) instead')
+	parser.add_argument('--merge', action='store_true', help='with --accounts, write one metalink for all accounts to DIR instead of one per account to DIR/EMAIL')
+	parser.add_argument('--cache', action='store_true', help='cache fetched orders')
+	parser.add_argument('--cache-dir', metavar='DIR', default='order_cache', help='order cache directory (default: order_cache)', dest='cache_dir')
+	parser.add_argument('--cache-ttl', metavar='HOURS', type=float, default=6, help='expire cached orders after HOURS hours (default: 6)', dest='cache_ttl')
+	parser.add_argument('--cache-size', metavar='MB', type=float, default=100, help='maximum order cache size in megabytes (default: 100)', dest='cache_size')
 	parser.add_argument('--platform', help='filter downloads to a certain platform (e.g.: android)')
 	parser.add_argument('--torrents', action='store_true', help='download .torrent files to download directory')
+	parser.add_argument('--torrent-jobs', metavar='N', type=int, default=4, help='number of .torrent files to download concurrently (default: 4)', dest='torrent_jobs')
 	parser.add_argument('--dir', default='dl', help='target download directory (default: dl)')
 	parser.add_argument('--save-links', metavar='FILE', help='save http/https links to given text file', dest='links')
 	parser.add_argument('--save-bt-links', metavar='FILE', help='save bittorrent links to given text file', dest='btlinks')
+	parser.add_argument('--save-aria2', metavar='FILE', help='save downloads to given aria2c input file, with target names and MD5 sums', dest='aria2')
+	parser.add_argument('--aria2-connections', metavar='[HOST=]N', action='append', default=[], help='with --save-aria2, use N connections per server (for HOST only, if given; may be repeated)', dest='aria2_connections')
+	parser.add_argument('--jobs', metavar='N', type=int, default=1, help='number of orders to fetch concurrently (default: 1)')
+	parser.add_argument('--rate', metavar='N', type=float, help='make at most N API requests per second (default: no limit)')
+	parser.add_argument('--retries', metavar='N', type=int, default=5, help='retry API requests which were throttled or failed to connect N times (default: 5)')
+	parser.add_argument('--sync', action='store_true', help='only fetch orders not yet recorded in DIR/hb.state')
+	parser.add_argument('--refresh-days', metavar='DAYS', type=float, help='re-fetch orders recorded by --sync or checkpointed more than DAYS ago', dest='refresh_days')
+	parser.add_argument('--update', action='store_true', help='merge changes into the existing DIR/hb.metalink and report them')
+	parser.add_argument('--save-delta', metavar='FILE', help='with --update, save the added, removed, changed and refreshed file names to given JSON file', dest='delta')
+	parser.add_argument('--dedup', action='store_true', help='describe downloads with identical contents only once, recording the other names as aliases in DIR/hb.aliases')
+	parser.add_argument('--shard', choices=('bundle', 'platform', 'both'), help='write one metalink per bundle and/or platform to DIR/hb.NAME.metalink, listed in DIR/hb.index', dest='shard_by')
+	parser.add_argument('--catalog', metavar='FILE', help='store the library in given SQLite catalog (see metahumble.py catalog)')
+	parser.add_argument('--metrics', metavar='FILE', help='save run metrics (phase times, request counts and latencies, cache hits, bytes written) to given JSON file')
+	parser.add_argument('--metrics-prom', metavar='FILE', help='save run metrics to given file in the Prometheus text format', dest='metrics_prom')
 
 	args = parser.parse_args()
+	if args.accounts is None and args.password is None:
+		parser.error('email and password are required unless --accounts is given')
+	if args.accounts is not None and args.email is not None:
+		parser.error('email and password cannot be combined with --accounts')
+	if args.accounts is not None and not args.merge and (args.links or args.btlinks or args.delta or args.aria2):
+		parser.error('--save-links, --save-bt-links, --save-aria2 and --save-delta require --merge with --accounts')
+
+	aria2_connections = {}
+	for value in args.aria2_connections:
+		host, _, count = value.rpartition('=')
+		if not count.isdigit():
+			parser.error('invalid --aria2-connections value: %s' % value)
+		aria2_connections[host or None] = int(count)
+
+	if args.accounts is not None:
+		try:
+			accounts = read_accounts(args.accounts)
+		except ValueError as e:
+			parser.error(str(e))
+		if not accounts:
+			parser.error('no accounts in %s' % args.accounts)
+
+	max_age = args.refresh_days * 24 * 60 * 60 if args.refresh_days is not None else None
 
-	linker = HumbleLinker()
-	if args.cache:
-		linker.enable_cache()
-	linker.login(args.email, args.password)
-	linker.run(args.dir, args.platform, args.links, args.btlinks, args.torrents)
+	import metrics, ratelimit
+	run_metrics = metrics.Metrics()
+	throttle = ratelimit.Throttle(args.jobs, args.rate, args.retries)
+	try:
+		if args.accounts is not None:
+			cache = OrderCache(args.cache_dir, args.cache_ttl * 60 * 60, args.cache_size * 1024 * 1024) if args.cache else None
+			run_accounts(accounts, args.dir, args.merge, args.platform, args.links, args.btlinks, args.torrents, args.jobs, args.sync, max_age, args.torrent_jobs, args.update, args.delta, args.dedup, cache, args.shard_by, run_metrics, throttle, args.aria2, aria2_connections, args.catalog)
+		else:
+			linker = HumbleLinker()
+			linker.metrics = run_metrics
+			linker.throttle = throttle
+			if args.cache:
+				linker.enable_cache(args.cache_dir, args.cache_ttl * 60 * 60, args.cache_size * 1024 * 1024)
+			linker.login(args.email, args.password)
+			linker.run(args.dir, args.platform, args.links, args.btlinks, args.torrents, args.jobs, args.sync, max_age, args.torrent_jobs, args.update, args.delta, args.dedup, args.shard_by, args.aria2, aria2_connections, args.catalog)
+	finally:
+		# Also written after a failed run, to show where it failed
+		throttle.report(run_metrics)
+		if args.metrics:
+			run_metrics.write_json(args.metrics)
+		if args.metrics_prom:
+			run_metrics.write_prometheus(args.metrics_prom)
 
 if __name__ == '__main__':
 	main()
@@ -20,7 +20,7 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-import binascii, glob, math, md5, os, re, sha, sys, time, urllib, urlparse, xml.dom
+import base64, binascii, glob, itertools, math, md5, os, re, sha, sys, time, urllib, urlparse, xml.dom
 from xml.dom.minidom import parse, Node
 from xml.sax.saxutils import escape
 
@@ -37,6 +37,24 @@ generator="Metalink Library %s" % current_version
 fs_encoding = sys.getfilesystemencoding()
 preference_ed2k = "95"
 verbose = False
+# Files are scanned in blocks of this size, or memory-mapped
+scan_buffer_size = 1024 * 1024
+scan_use_mmap = False
+# Compute each digest in its own thread, with the reader up to
+# scan_read_ahead blocks ahead
+scan_threads = False
+scan_read_ahead = 4
+# Number of processes hashing the pieces of a file, each reading its own
+# range of the file, while the whole-file digests are computed by the
+# scanning process (0 hashes the pieces while scanning)
+scan_processes = 0
+# SQLite database remembering the hashes of scanned files (see HashCache)
+scan_cache = None
+# Compute Tiger Tree hashes (see tiger.py, which is slow)
+scan_tth = False
+# Part size of ed2k hashes, and block size of AICH hashes
+ed2k_part_size = 9728000
+aich_block_size = 184320
 # Command-line options
 _opts = {}
 
@@ -155,29 +173,37 @@ def get_url(url):
 
     return ''
 
+def encode_utf8(text):
+    try:
+        return text.encode('utf-8')
+    except:
+        return text.decode('latin1').encode('utf-8')
+
 def unique(seq):
     d = {}
     return [d.setdefault(e,e) for e in seq if e not in d]
 
 def generate_verification_and_resources(self, add_p2p=True, protocols=[], is_child=True):
-    text = ''
+    text = []
     indentation = is_child and '    ' or '  '
 
     # Verification
-    if self.hashes.pieces or self.signature or self.hashes.has_one('ed2k md5 sha1 sha256'):
-        text += indentation + '  <verification>' + os.linesep
+    if self.hashes.pieces or self.signature or self.hashes.has_one('ed2k md5 sha1 sha256 aich tth'):
+        text.append(indentation + '  <verification>' + os.linesep)
         # TODO: ed2k really allowed?
-        for hash, value in sorted(self.hashes.get_multiple('ed2k md5 sha1 sha256').items()):
-            text += '%s    <hash type="%s">%s</hash>%s' % (indentation, hash, value.lower(), os.linesep)
+        for hash, value in sorted(self.hashes.get_multiple('ed2k md5 sha1 sha256 aich tth').items()):
+            # AICH and Tiger Tree hashes are base32 encoded
+            value = hash in ('aich', 'tth') and value.upper() or value.lower()
+            text.append('%s    <hash type="%s">%s</hash>%s' % (indentation, hash, value, os.linesep))
         # TODO: Why len(self.pieces) > 1 ?
         if len(self.hashes.pieces):
-            text += indentation + '    <pieces type="'+self.hashes.piecetype+'" length="'+self.hashes.piecelength+'">' + os.linesep
+            text.append(indentation + '    <pieces type="'+self.hashes.piecetype+'" length="'+self.hashes.piecelength+'">' + os.linesep)
             for id, piece in enumerate(self.hashes.pieces):
-                text += indentation + '      <hash piece="'+str(id)+'">'+piece+'</hash>' + os.linesep
-            text += indentation + '    </pieces>' + os.linesep
+                text.append(indentation + '      <hash piece="'+str(id)+'">'+piece+'</hash>' + os.linesep)
+            text.append(indentation + '    </pieces>' + os.linesep)
         if self.signature.strip() != "":
-            text += '%s    <signature type="%s">%s</signature>%s' % (indentation, self.signature_type, self.signature, os.linesep)
-        text += indentation + '  </verification>' + os.linesep
+            text.append('%s    <signature type="%s">%s</signature>%s' % (indentation, self.signature_type, self.signature, os.linesep))
+        text.append(indentation + '  </verification>' + os.linesep)
 
     # Add missing P2P resources implicitly if hashes are available
     if add_p2p and 'ed2k' in self.hashes and self.size and getattr(self, 'filename', '') and 'ed2k' not in protocols:
@@ -193,7 +219,7 @@ def generate_verification_and_resources(self, add_p2p=True, protocols=[], is_chi
         if 'ed2k' in self.hashes:
             hashes.append("urn:ed2k:%s" % self.hashes['ed2k'].lower())
             # Another way of including the ED2K hash: hashes.append("urn:ed2khash:%s" % self.hashes['ed2k'].lower())
-        # TODO: tiger-tree root hash: http://wiki.shareaza.com/static/MagnetsMakeAndUse
+        if 'tth' in self.hashes: hashes.append("urn:tree:tiger:%s" % self.hashes['tth'].upper())
         # TODO: kzhash
         if magnet or hashes:
             params = urllib.urlencode(magnet)
@@ -207,19 +233,19 @@ def generate_verification_and_resources(self, add_p2p=True, protocols=[], is_chi
 
     if self.resources:
         if getattr(self, 'maxconn_total', '') and "" != self.maxconn_total.strip() and "-" != self.maxconn_total.strip():
-            text += indentation + '  <resources maxconnections="' + self.maxconn_total + '">' + os.linesep
+            text.append(indentation + '  <resources maxconnections="' + self.maxconn_total + '">' + os.linesep)
         else:
-            text += indentation + "  <resources>" + os.linesep
+            text.append(indentation + "  <resources>" + os.linesep)
         for res in self.resources:
             details = ''
             if res.location.strip() != "":
                 details += ' location="'+res.location.lower()+'"'
             if res.preference.strip() != "": details += ' preference="'+res.preference+'"'
             if res.conns.strip() != "" and res.conns.strip() != "-" : details += ' maxconnections="'+res.conns+'"'
-            text += '%s    <url type="%s"%s>%s</url>%s' % (indentation, res.type, details, escape(res.url), os.linesep)
-        text += indentation + '  </resources>' + os.linesep
+            text.append('%s    <url type="%s"%s>%s</url>%s' % (indentation, res.type, details, escape(res.url), os.linesep))
+        text.append(indentation + '  </resources>' + os.linesep)
 
-    return text
+    return ''.join(text)
 
 # return 0=no valid URL, 1=URL prefix, 2=normal URL
 def is_url(url):
@@ -231,11 +257,282 @@ def is_url(url):
         return 0
     return url[-1] == '/' and 1 or 2
 
+def advise_sequential(fp):
+    """Tell the kernel that fp will be read sequentially, if possible"""
+    # posix_fadvise is not available in the os module of Python 2
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        libc.posix_fadvise(fp.fileno(), ctypes.c_long(0), ctypes.c_long(0), 2) # POSIX_FADV_SEQUENTIAL
+    except (ImportError, OSError, AttributeError):
+        pass
+
+def read_blocks(fp, buffer_size, use_mmap=False, buffers=1):
+    """Yield (data, offset, length) for consecutive blocks of the file fp.
+    Each block is data[offset:offset + length], which stays valid until
+    as many blocks as there are buffers have been requested after it. Use
+    buffer(data, offset, length) to access it without copying."""
+    advise_sequential(fp)
+    if use_mmap:
+        import mmap
+        try:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError): # Empty files cannot be mapped
+            mm = None
+        if mm is not None:
+            # The mapping is released with the last view of it, which may
+            # be used after the generator has finished
+            for offset in xrange(0, len(mm), buffer_size):
+                yield mm, offset, min(buffer_size, len(mm) - offset)
+            return
+    pool = [bytearray(buffer_size) for i in range(buffers)]
+    for i in itertools.count():
+        data = pool[i % buffers]
+        length = fp.readinto(data)
+        if not length: break
+        yield data, 0, length
+
+class BlockHash(object):
+    """Hash of all blocks (see read_blocks) passed to update"""
+    def __init__(self, hash, view=buffer):
+        self.hash = hash
+        self.view = view
+
+    def update(self, data, offset, length):
+        self.hash.update(self.view(buffer(data, offset, length)))
+
+class PieceHash(object):
+    """Digests of consecutive pieces of piecelength bytes of the blocks
+    passed to update. hash is an empty hash object to copy for each piece."""
+    def __init__(self, hash, piecelength, view=buffer):
+        self.empty = hash
+        self.piecelength = piecelength
+        self.view = view
+        self.hash = hash.copy()
+        self.length = 0
+        self.digests = []
+
+    def update(self, data, offset, length):
+        pos = 0
+        while pos < length:
+            numbytes = min(length - pos, self.piecelength - self.length)
+            self.hash.update(self.view(buffer(data, offset + pos, numbytes)))
+            self.length += numbytes
+            pos += numbytes
+            if self.length == self.piecelength:
+                self.digests.append(self.hash.digest())
+                self.hash = self.empty.copy()
+                self.length = 0
+
+    def finish(self):
+        """Add the digest of the last, incomplete piece and return the digests"""
+        if self.length:
+            self.digests.append(self.hash.digest())
+            self.hash = self.empty.copy()
+            self.length = 0
+        return self.digests
+
+class AICHHash(object):
+    """AICH (Advanced Intelligent Corruption Handling) hash of the blocks
+    passed to update: a sha1 hash tree over blocks of aich_block_size
+    bytes, which do not cross the boundaries of the ed2k parts. hash is an
+    empty sha1 hash object."""
+    def __init__(self, size, hash):
+        self.size = size
+        self.empty = hash
+        self.hash = hash.copy()
+        self.pos = 0
+        self.end = self.block_end()
+        self.digests = []
+
+    def block_end(self):
+        part = self.pos - self.pos % ed2k_part_size
+        block = self.pos - (self.pos - part) % aich_block_size
+        return min(self.size, part + ed2k_part_size, block + aich_block_size)
+
+    def update(self, data, offset, length):
+        pos = 0
+        while pos < length:
+            numbytes = min(length - pos, self.end - self.pos)
+            self.hash.update(buffer(data, offset + pos, numbytes))
+            self.pos += numbytes
+            pos += numbytes
+            if self.pos == self.end:
+                self.digests.append(self.hash.digest())
+                self.hash = self.empty.copy()
+                self.end = self.block_end()
+
+    def tree(self, size, is_left, digests):
+        """Root digest of a subtree of size bytes, as built by eMule: the
+        left branch gets the larger half of the parts (or blocks)"""
+        if size <= aich_block_size:
+            return next(digests)
+        base = size > ed2k_part_size and ed2k_part_size or aich_block_size
+        blocks = (size + base - 1) / base
+        left = (is_left and blocks + 1 or blocks) / 2 * base
+        hash = self.empty.copy()
+        hash.update(self.tree(left, True, digests))
+        hash.update(self.tree(size - left, False, digests))
+        return hash.digest()
+
+    def finish(self):
+        """Return the root digest"""
+        return self.tree(self.size, True, iter(self.digests))
+
+def hash_piece_range(task):
+    """Return the sha1 digests of the pieces between start and end of a file.
+    Runs in a worker process."""
+    filename, start, end, piecelength, buffer_size = task
+    pieces = PieceHash(sha.new(), piecelength)
+    fp = open(filename, "rb", 0)
+    try:
+        fp.seek(start)
+        while start < end:
+            data = fp.read(min(buffer_size, end - start))
+            if not data: break
+            pieces.update(data, 0, len(data))
+            start += len(data)
+    finally:
+        fp.close()
+    return pieces.finish()
+
+def piece_ranges(size, piecelength, count):
+    """Split a file into about count ranges of whole pieces"""
+    numpieces = (size + piecelength - 1) / piecelength
+    step = max(1, (numpieces + count - 1) / count) * piecelength
+    return [(start, min(start + step, size)) for start in xrange(0, size, step)]
+
+def hash_blocks(blocks, consumers, read_ahead=0):
+    """Pass each block (see read_blocks) to the update method of each consumer.
+    With read_ahead, each consumer runs in its own thread, so that the
+    digests are computed in parallel (hashlib releases the GIL). The reader
+    is then up to read_ahead blocks ahead of the slowest consumer, so blocks
+    must stay valid that long."""
+    if not read_ahead or not consumers:
+        for block in blocks:
+            for consumer in consumers:
+                consumer.update(*block)
+        return
+
+    import threading, Queue
+    free = threading.Semaphore(read_ahead)
+    lock = threading.Lock()
+    errors = []
+    queues = [Queue.Queue() for consumer in consumers]
+    def work(consumer, queue):
+        while True:
+            item = queue.get()
+            if item is None: return
+            block, remaining = item
+            try:
+                if not errors: consumer.update(*block)
+            except:
+                errors.append(sys.exc_info())
+            with lock:
+                remaining[0] -= 1
+                if not remaining[0]: free.release()
+
+    workers = [threading.Thread(target=work, args=args) for args in zip(consumers, queues)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        blocks = iter(blocks)
+        while not errors:
+            # Consumers finish the blocks in order, so this waits for the
+            # oldest block (whose buffer is reused by the next one)
+            free.acquire()
+            try:
+                block = next(blocks)
+            except StopIteration:
+                break
+            remaining = [len(consumers)]
+            for queue in queues:
+                queue.put((block, remaining))
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+class HashCache(object):
+    """Hashes and pieces of scanned files, by device and inode. Entries are
+    only valid while the size and modification time of the file match."""
+    hash_types = ('ed2k', 'md5', 'sha1', 'sha256', 'aich', 'tth')
+
+    def __init__(self, filename):
+        import sqlite3
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS hashes (
+            dev INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            ed2k TEXT,
+            md5 TEXT,
+            sha1 TEXT,
+            sha256 TEXT,
+            piecelength INTEGER NOT NULL,
+            pieces TEXT NOT NULL,
+            aich TEXT,
+            tth TEXT,
+            PRIMARY KEY (dev, inode)
+        )''')
+        # Add the columns of hash types added later to older caches
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(hashes)')]
+        for hash in self.hash_types:
+            if hash not in columns:
+                try:
+                    self.db.execute('ALTER TABLE hashes ADD COLUMN %s TEXT' % hash)
+                except sqlite3.OperationalError, e:
+                    # Another process added it in the meantime
+                    if 'duplicate column name' not in str(e):
+                        raise
+        self.db.commit()
+
+    def key(self, st):
+        mtime_ns = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1000000000)
+        return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+    def get(self, st):
+        """Return the entry of the file with the stat result st as a dict of
+        hashes, pieces and piecelength (0 without pieces), or None"""
+        dev, inode, size, mtime_ns = self.key(st)
+        row = self.db.execute('SELECT size, mtime_ns, piecelength, pieces, %s FROM hashes WHERE dev = ? AND inode = ?' % ', '.join(self.hash_types), (dev, inode)).fetchone()
+        if row is None or row[:2] != (size, mtime_ns):
+            return None
+        hashes = dict((hash, value) for hash, value in zip(self.hash_types, row[4:]) if value)
+        return {'hashes': hashes, 'piecelength': row[2], 'pieces': row[3].split()}
+
+    def put(self, st, hashes, piecelength=0, pieces=[]):
+        """Remember hashes (a dict) and the pieces of the file with the stat
+        result st, keeping other hashes of an entry which is still valid"""
+        entry = self.get(st)
+        if entry:
+            for hash, value in entry['hashes'].items():
+                hashes.setdefault(hash, value)
+            if not piecelength:
+                piecelength, pieces = entry['piecelength'], entry['pieces']
+        columns = ('dev', 'inode', 'size', 'mtime_ns', 'piecelength', 'pieces') + self.hash_types
+        values = self.key(st) + (piecelength, ' '.join(pieces)) + tuple(hashes.get(hash) for hash in self.hash_types)
+        self.db.execute('INSERT OR REPLACE INTO hashes (%s) VALUES (%s)' % (', '.join(columns), ', '.join('?' * len(columns))), values)
+        self.db.commit()
+
+_hash_caches = {}
+def open_hash_cache(filename):
+    """Return the HashCache of filename, opened once per process"""
+    key = (filename, os.getpid())
+    if key not in _hash_caches:
+        _hash_caches[key] = HashCache(filename)
+    return _hash_caches[key]
+
 def main(args=[]):
-    global _opts, verbose
+    global _opts, verbose, scan_use_mmap, scan_threads, scan_processes, scan_cache, scan_tth
 
     # Read arguments and options
-    optParser = OptParser(['create-torrent=sURLs','Create torrent with given tracker URLs (comma separates groups, space separates group members: "t1, t2a t2b")', 'overwrite','Overwrite existing files (otherwise append .new)', 'template|t=sFILE','Metalink template file', 'url-prefix=sURL','URL prefix (where metalink should be placed online)', 'verbose|v','Verbose output', 'V','Show program version and exit', 'help|h','Print this message and exit\n\nMetalink options:',
+    optParser = OptParser(['create-torrent=sURLs','Create torrent with given tracker URLs (comma separates groups, space separates group members: "t1, t2a t2b")', 'overwrite','Overwrite existing files (otherwise append .new)', 'mmap','Memory-map files while hashing them', 'threads','Compute each hash in its own thread', 'processes=iN','Hash the pieces of each file in N processes', 'recursive|r','Process directories recursively', 'jobs|j=iN','Process N files at once', 'hash-cache=sFILE','Remember the hashes of files in FILE, and do not scan unchanged files again', 'tth','Compute Tiger Tree hashes for magnet links (slow)', 'template|t=sFILE','Metalink template file', 'url-prefix=sURL','URL prefix (where metalink should be placed online)', 'verbose|v','Verbose output', 'V','Show program version and exit', 'help|h','Print this message and exit\n\nMetalink options:',
         'changelog=sTEXT','Changelog',
         'copyright=sTEXT','Copyright',
         'description=sTEXT','Description',
@@ -262,6 +559,16 @@ def main(args=[]):
         usage_and_exit(os.linesep.join(errors), optParser.getHelp())
     if _opts['V']:
         usage_and_exit(False)
+    if _opts['mmap']:
+        scan_use_mmap = True
+    if _opts['threads']:
+        scan_threads = True
+    if _opts['processes']:
+        scan_processes = int(_opts['processes'])
+    if _opts['hash_cache']:
+        scan_cache = os.path.realpath(_opts['hash_cache'])
+    if _opts['tth']:
+        scan_tth = True
 
     # Sanitize options
     # TODO: check rest of _opts
@@ -295,7 +602,11 @@ def main(args=[]):
     # Search files and url_prefix
     for arg in args:
         if os.path.isdir(arg):
-            for file in [file for file in glob.glob('%s%s*' % (os.path.realpath(arg), os.sep)) if os.path.isfile(file)]:
+            if _opts['recursive']:
+                dir_files = [os.path.join(root, file) for root, dirs, _dir_files in os.walk(os.path.realpath(arg)) for file in sorted(_dir_files)]
+            else:
+                dir_files = glob.glob('%s%s*' % (os.path.realpath(arg), os.sep))
+            for file in [file for file in dir_files if os.path.isfile(file)]:
                 _files.append(file)
                 # Search parallel helper files
                 _files.extend(m.find_helper_files(file))
@@ -318,33 +629,41 @@ def main(args=[]):
                 _files.extend(m.find_helper_files(file))
     _files = unique(_files)
 
+    # Files are matched with their helper files by name. When directories
+    # are processed recursively, names are qualified with the directory,
+    # as files of the same name may be found in several directories.
+    def key(file, name):
+        if _opts['recursive']:
+            return os.path.join(os.path.dirname(file), name)
+        return name
+
     # Categorize and filter files (hashes, mirrors, torrents, signatures)
     for file in _files:
         _file = os.path.basename(file)
         if _file.endswith('.metalink'):
-            _metalinks[_file[:-9]] = file
+            _metalinks[key(file, _file[:-9])] = file
         elif _file.endswith('.torrent'):
-            _torrents[_file[:-8]] = file
+            _torrents[key(file, _file[:-8])] = file
         elif _file.endswith('.mirrors') or _file.lower() == 'mirrors':
-            key = _file.lower() == 'mirrors' and _file or _file[:-8]
-            _mirrors[key] = file
+            _key = _file.lower() == 'mirrors' and _file or _file[:-8]
+            _mirrors[key(file, _key)] = file
         elif m.hashes.is_hash_file(_file):
-            hash_file = m.hashes.last_hash_file
+            hash_file = key(file, m.hashes.last_hash_file)
             if hash_file not in _hashes:
                 _hashes[hash_file] = {}
-            if hash_file == _file:
-                key = os.path.dirname(file)
+            if m.hashes.last_hash_file == _file:
+                _key = os.path.dirname(file)
             else:
-                key = _file[len(hash_file)+1:]
-            _hashes[hash_file][key] = file
+                _key = _file[len(m.hashes.last_hash_file)+1:]
+            _hashes[hash_file][_key] = file
         elif m.hashes.is_signature_file(_file):
-            hash_file = m.hashes.last_hash_file
+            hash_file = key(file, m.hashes.last_hash_file)
             if hash_file not in _signatures:
                 _signatures[hash_file] = {}
-            _signatures[hash_file][_file[len(hash_file)+1:]] = file
-            _signatures[m.hashes.last_hash_file] = file
+            _signatures[hash_file][_file[len(m.hashes.last_hash_file)+1:]] = file
+            _signatures[hash_file] = file
         elif os.stat(file).st_size > 1000000:
-            files[_file] = file
+            files[key(file, _file)] = file
         else:
             files_skipped.append(file)
 
@@ -352,38 +671,18 @@ def main(args=[]):
         files_skipped.sort()
         print >>sys.stderr, "Skipped the following files:\n%s" % "\n".join(files_skipped)
 
+    jobs = int(_opts['jobs'] or 1)
+
     # Metalink update mode
     if not files and len(_metalinks):
         print 'Metalink update mode (apply options and create torrents)'
-        for filename, file in _metalinks.items():
-            m = Metalink(False)
-            m.load_file(file, False)
-
-            if m.version and m.version != new_version:
-                m.change_filename(new_version, m.version)
-                new_file = os.path.dirname(file) + os.sep + filename.replace(m.version, new_version) + '.metalink'
-            else:
-                new_file = file
-
-            # Parse parallel files
-            local_file = new_file[:-9]
-            torrent = local_file + '.torrent'
-            if os.path.isfile(torrent):
-                m.parse_torrent(torrent)
-            if os.path.isfile(local_file):
-                m.scan_file(local_file)
-
-            # Force current creation date (may be overwritten by command-line option afterwards)
-            m.pubdate = ''
-            m.apply_command_line_options()
-            if os.path.isfile(new_file) and not _opts['overwrite']:
-                new_file += '.new'
-            m.generate(new_file)
+        tasks = [(filename, file, new_version) for filename, file in _metalinks.items()]
+        run_jobs(update_metalink, largest_first(tasks, lambda task: task[1][:-9]), jobs)
         return
 
     # Mirror update mode
     if not files and len(_metalinks) == 1 and len(_mirrors) == 1:
-        files[_metalinks.keys()[0]] = _metalinks.keys()[0]
+        files[_metalinks.keys()[0]] = os.path.basename(_metalinks.keys()[0])
 
     # Filter general help files
     for filename in set(_metalinks.keys()).difference(set(files.keys())):
@@ -399,54 +698,141 @@ def main(args=[]):
     if not files:
         usage_and_exit(None, optParser.getHelp()) # 'No files to process'
 
-    for filename, file in files.items():
-        print 'Processing %s' % file
-        m = Metalink()
-
-        # Parse metalink template
-        if filename in _metalinks:
-            m.load_file(_metalinks[filename])
-        elif _metalink_general:
-            m.load_file(_metalink_general)
-
-        # Force pubdate to be the current timestamp
-        m.pubdate = ''
-
-        # Overwrite old mirror filenames from template
-        m.change_filename(filename)
-
-        if filename in _mirrors:
-            m.clear_res('http ftp https ftps')
-            m.parse_mirrors(_mirrors[filename], '', '', True, True)
-            # m.file.mirrors.change_filename(filename)
-        elif _mirrors_general.mirrors:
-            _mirrors_general.change_filename(filename)
-            m.file.mirrors.add(_mirrors_general, True)
-
-        # Parse torrent files
-        if filename in _torrents:
-            m.parse_torrent(_torrents[filename])
-        elif len(_torrents) == len(files) == 1:
-            m.parse_torrent(_torrents.values()[0])
-
-        # Parse signature file
-        if filename in _signatures:
-            m.import_signature(_signatures[filename])
-
-        # Parse hash files
-        _hashes_general.set_file(file)
-        m.file.hashes.update(_hashes_general)
-        if filename in _hashes:
-            m.file.hashes.files = _hashes[filename].values()
-            m.file.hashes.parse_files()
-        m.file.hashes.set_file(file)
+    helpers = {
+        'metalinks': _metalinks,
+        'metalink_general': _metalink_general,
+        'mirrors': _mirrors,
+        'mirrors_general': _mirrors_general,
+        'torrents': _torrents,
+        'single_torrent': len(_torrents) == len(files) == 1 and _torrents.values()[0] or None,
+        'signatures': _signatures,
+        'hashes': _hashes,
+        'hashes_general': _hashes_general,
+        'url_prefix': url_prefix,
+    }
+    tasks = [(filename, file, helpers) for filename, file in files.items()]
+    run_jobs(process_file, largest_first(tasks, lambda task: task[1]), jobs)
+
+def largest_first(tasks, path):
+    """Sort tasks by the size of the file path(task), largest first, so
+    that parallel jobs do not end with one large file"""
+    def size(task):
+        try:
+            return os.stat(path(task)).st_size
+        except OSError:
+            return 0
+    return sorted(tasks, key=size, reverse=True)
+
+def run_jobs(function, tasks, jobs=1):
+    """Call function(*task) for each task, in a pool of jobs processes if
+    there is more than one job"""
+    global scan_processes
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            function(*task)
+        return
 
-        if os.path.isfile(file):
-            # Scan file for remaining hashes
-            m.scan_file(file)
+    import multiprocessing
+    # Workers cannot start pools of their own
+    scan_processes = 0
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for output in pool.imap_unordered(run_job, [(function, task) for task in tasks]):
+            sys.stdout.write(output)
+    finally:
+        pool.terminate()
+
+# Runs in a worker process; returns the output of the job, so that the
+# output of jobs running at the same time is not mixed up
+def run_job(job):
+    from cStringIO import StringIO
+    function, task = job
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        function(*task)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+def update_metalink(filename, file, new_version):
+    """Apply the command line options to the metalink file and create torrents"""
+    m = Metalink(False)
+    m.load_file(file, False)
+
+    if m.version and m.version != new_version:
+        m.change_filename(new_version, m.version)
+        new_file = os.path.dirname(file) + os.sep + os.path.basename(filename).replace(m.version, new_version) + '.metalink'
+    else:
+        new_file = file
+
+    # Parse parallel files
+    local_file = new_file[:-9]
+    torrent = local_file + '.torrent'
+    if os.path.isfile(torrent):
+        m.parse_torrent(torrent)
+    if os.path.isfile(local_file):
+        m.scan_file(local_file)
+
+    # Force current creation date (may be overwritten by command-line option afterwards)
+    m.pubdate = ''
+    m.apply_command_line_options()
+    if os.path.isfile(new_file) and not _opts['overwrite']:
+        new_file += '.new'
+    m.generate(new_file)
+
+def process_file(filename, file, helpers):
+    """Generate the metalink of file, using the helper files found by main"""
+    print 'Processing %s' % file
+    name = os.path.basename(filename)
+    m = Metalink()
 
-        m.url_prefix = url_prefix
-        m.generate(True)
+    # Parse metalink template
+    if filename in helpers['metalinks']:
+        m.load_file(helpers['metalinks'][filename])
+    elif helpers['metalink_general']:
+        m.load_file(helpers['metalink_general'])
+
+    # Force pubdate to be the current timestamp
+    m.pubdate = ''
+
+    # Overwrite old mirror filenames from template
+    m.change_filename(name)
+
+    _mirrors_general = helpers['mirrors_general']
+    if filename in helpers['mirrors']:
+        m.clear_res('http ftp https ftps')
+        m.parse_mirrors(helpers['mirrors'][filename], '', '', True, True)
+        # m.file.mirrors.change_filename(name)
+    elif _mirrors_general.mirrors:
+        _mirrors_general.change_filename(name)
+        m.file.mirrors.add(_mirrors_general, True)
+
+    # Parse torrent files
+    if filename in helpers['torrents']:
+        m.parse_torrent(helpers['torrents'][filename])
+    elif helpers['single_torrent']:
+        m.parse_torrent(helpers['single_torrent'])
+
+    # Parse signature file
+    if filename in helpers['signatures']:
+        m.import_signature(helpers['signatures'][filename])
+
+    # Parse hash files
+    _hashes_general = helpers['hashes_general']
+    _hashes_general.set_file(file)
+    m.file.hashes.update(_hashes_general)
+    if filename in helpers['hashes']:
+        m.file.hashes.files = helpers['hashes'][filename].values()
+        m.file.hashes.parse_files()
+    m.file.hashes.set_file(file)
+
+    if os.path.isfile(file):
+        # Scan file for remaining hashes
+        m.scan_file(file)
+
+    m.url_prefix = helpers['url_prefix']
+    m.generate(True)
 
 
 class Resource(object):
@@ -558,21 +944,28 @@ class Metafile(object):
         fp.close()
         return True
 
-    def scan_file(self, filename, use_chunks=True, max_chunks=255, chunk_size=256, progresslistener=None):
+    def scan_file(self, filename, use_chunks=True, max_chunks=255, chunk_size=256, progresslistener=None, buffer_size=None, use_mmap=None, threads=None, processes=None, tth=None):
         if verbose: print "Scanning file..."
+        if buffer_size is None: buffer_size = scan_buffer_size
+        if use_mmap is None: use_mmap = scan_use_mmap
+        if threads is None: threads = scan_threads
+        if processes is None: processes = scan_processes
+        if tth is None: tth = scan_tth
         # Filename and size
         self.filename = os.path.basename(filename)
         if not self.hashes.filename:
             self.hashes.filename = self.filename
-        size = os.stat(filename).st_size
+        st = os.stat(filename)
+        size = st.st_size
         self.size = str(size)
 
-        known_hashes = self.hashes.get_multiple('ed2k md5 sha1 sha256')
+        names = 'ed2k md5 sha1 sha256 aich' + (tth and ' tth' or '')
+        known_hashes = self.hashes.get_multiple(names)
         # If all hashes and pieces are already known, do nothing
-        if 4 == len(known_hashes) and self.hashes.pieces:
+        if len(names.split()) == len(known_hashes) and self.hashes.pieces:
             return True
 
-        piecelength_ed2k = 9728000
+        piecelength_ed2k = ed2k_part_size
         # Calculate piece length
         if use_chunks:
             minlength = chunk_size*1024
@@ -584,8 +977,8 @@ class Metafile(object):
             if numpieces < 2: use_chunks = False
         hashes = {}
         # ADDED: MD4 for calculating ed2k hashes
-        # TODO: AICH ed2k hashes (allow much better error recognition and repair, 180 KB pieces instead of 9500 KB)
         # Try to use hashlib
+        md4_view = buffer
         try:
             import hashlib
             hashes['md4'] = hashlib.new('md4')
@@ -597,22 +990,22 @@ class Metafile(object):
             try:
                 import Crypto.Hash.MD4
                 hashes['md4'] = Crypto.Hash.MD4.new()
+                # It may not accept buffers
+                md4_view = str
             except:
                 hashes['md4'] = None
             print "Hashlib not available. No support for SHA-256%s" % (hashes['md4'] and "." or " and ED2K.")
             hashes['md5'] = md5.new()
             hashes['sha1'] = sha.new()
             hashes['sha256'] = None
-        if hashes['md4']:
-            md4piecehash = None
-            if size > piecelength_ed2k:
-                md4hash_copy = hashes['md4'].copy()
-                md4piecehash = md4hash_copy.copy()
-                length_ed2k = 0
         sha1hash_copy = hashes['sha1'].copy()
-        piecehash = sha1hash_copy.copy()
-        piecenum = 0
-        length = 0
+        # AICH hashes allow ed2k clients to repair blocks of 180 KB instead
+        # of parts of 9500 KB, and Tiger Tree hashes blocks of 1 KB
+        hashes['aich'] = size and AICHHash(size, sha1hash_copy) or None
+        hashes['tth'] = None
+        if tth:
+            import tiger
+            hashes['tth'] = tiger.TigerTree()
 
         # If some hashes are already available, do not calculate them
         if 'ed2k' in known_hashes:
@@ -626,83 +1019,98 @@ class Metafile(object):
         if not self.hashes.piecetype:
             self.hashes.piecetype = "sha1"
 
-        num_reads = math.ceil(size / 4096.0)
-        reads_per_progress = int(math.ceil(num_reads / 100.0))
-        reads_left = reads_per_progress
-        progress = 0
-        fp = open(filename, "rb")
-        while True:
-            data = fp.read(4096)
-            if data == "": break
-            # Progress updating
-            if progresslistener:
-                reads_left -= 1
-                if reads_left <= 0:
-                    reads_left = reads_per_progress
-                    progress += 1
-                    result = progresslistener.Update(progress)
-                    if get_first(result) == False:
-                        if verbose: print "Cancelling scan!"
-                        return False
-            # Process the data
-            if hashes['md5']: hashes['md5'].update(data)
-            if hashes['sha1']: hashes['sha1'].update(data)
-            if hashes['sha256']: hashes['sha256'].update(data)
-            left = len(data)
-            if hashes['md4']:
-                if md4piecehash:
-                    l = left
-                    numbytes_ed2k = 0
-                    while l > 0:
-                        if length_ed2k + l <= piecelength_ed2k:
-                            if numbytes_ed2k:
-                                md4piecehash.update(data[numbytes_ed2k:])
-                            else:
-                                md4piecehash.update(data)
-                            length_ed2k += l
-                            l = 0
-                        else:
-                            numbytes_ed2k = piecelength_ed2k - length_ed2k
-                            md4piecehash.update(data[:numbytes_ed2k])
-                            length_ed2k = piecelength_ed2k
-                            l -= numbytes_ed2k
-                        if length_ed2k == piecelength_ed2k:
-                            hashes['md4'].update(md4piecehash.digest())
-                            md4piecehash = md4hash_copy.copy()
-                            length_ed2k = 0
-                else:
-                    hashes['md4'].update(data)
-            while use_chunks and left > 0:
-                if length + left <= self.hashes.piecelength:
-                    piecehash.update(data)
-                    length += left
-                    left = 0
-                else:
-                    numbytes = self.hashes.piecelength - length
-                    piecehash.update(data[:numbytes])
-                    length = self.hashes.piecelength
-                    data = data[numbytes:]
-                    left -= numbytes
-                if length == self.hashes.piecelength:
-                    if verbose: print "Done with piece hash", len(self.hashes.pieces)
-                    self.hashes.pieces.append(piecehash.hexdigest())
-                    piecehash = sha1hash_copy.copy()
-                    length = 0
-        if use_chunks:
-            if length > 0:
-                if verbose: print "Done with piece hash", len(self.hashes.pieces)
-                self.hashes.pieces.append(piecehash.hexdigest())
+        # Use the hashes remembered for an unchanged file, if they include
+        # all hashes to be computed
+        cache = scan_cache and open_hash_cache(scan_cache)
+        if cache:
+            cached = cache.get(st)
+            needed = [hash == 'md4' and 'ed2k' or hash for hash in 'md4 md5 sha1 sha256 aich tth'.split() if hashes[hash]]
+            if cached and not [hash for hash in needed if hash not in cached['hashes']] and (not use_chunks or cached['piecelength'] == self.hashes.piecelength):
+                if verbose: print "Using cached hashes"
+                for hash in needed:
+                    self.hashes[hash] = cached['hashes'][hash]
+                if use_chunks:
+                    self.hashes.pieces = cached['pieces']
+                self.hashes.piecelength = str(self.hashes.piecelength)
+                if progresslistener: progresslistener.Update(100)
+                return True
+
+        # Each consumer computes one digest of the blocks of the file
+        consumers = []
+        for hash in 'md5 sha1 sha256'.split():
+            if hashes[hash]: consumers.append(BlockHash(hashes[hash]))
+        for hash in 'aich tth'.split():
+            if hashes[hash]: consumers.append(hashes[hash])
+        md4pieces = None
+        if hashes['md4']:
+            if size > piecelength_ed2k:
+                md4pieces = PieceHash(hashes['md4'].copy(), piecelength_ed2k, md4_view)
+                consumers.append(md4pieces)
+            else:
+                consumers.append(BlockHash(hashes['md4'], md4_view))
+        pool = None
+        if use_chunks and processes:
+            # The pieces are hashed by worker processes while the file is
+            # scanned for the other digests
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            tasks = [(filename, start, end, self.hashes.piecelength, buffer_size) for start, end in piece_ranges(size, self.hashes.piecelength, processes * 4)]
+            piece_digests = pool.map_async(hash_piece_range, tasks)
+        elif use_chunks:
+            pieces = PieceHash(sha1hash_copy, self.hashes.piecelength)
+            consumers.append(pieces)
+
+        read_ahead = threads and scan_read_ahead or 0
+        cancelled = []
+        def blocks():
+            progress = 0
+            done = 0
+            for data, offset, n in read_blocks(fp, buffer_size, use_mmap, max(read_ahead, 1)):
+                # Progress updating
+                if progresslistener:
+                    done += n
+                    if size and done * 100 / size > progress:
+                        progress = min(99, done * 100 / size)
+                        result = progresslistener.Update(progress)
+                        if get_first(result) == False:
+                            if verbose: print "Cancelling scan!"
+                            cancelled.append(True)
+                            return
+                yield data, offset, n
+
+        fp = open(filename, "rb", 0)
+        try:
+            hash_blocks(blocks(), consumers, read_ahead)
+            if pool and not cancelled:
+                piece_digests = [digest for digests in piece_digests.get() for digest in digests]
+        finally:
+            fp.close()
+            if pool: pool.terminate()
+        if cancelled:
+            return False
+
+        if pool:
+            self.hashes.pieces = [binascii.hexlify(digest) for digest in piece_digests]
+        elif use_chunks:
+            self.hashes.pieces = [binascii.hexlify(digest) for digest in pieces.finish()]
             if verbose: print "Total number of pieces:", len(self.hashes.pieces)
-        fp.close()
         if hashes['md4']:
-            if md4piecehash and length_ed2k:
-                hashes['md4'].update(md4piecehash.digest())
+            if md4pieces:
+                for digest in md4pieces.finish():
+                    hashes['md4'].update(digest)
             self.hashes['ed2k'] = hashes['md4'].hexdigest()
         for hash in 'md5 sha1 sha256'.split():
             if hashes[hash]:
                 self.hashes[hash] = hashes[hash].hexdigest()
+        for hash in 'aich tth'.split():
+            if hashes[hash]:
+                self.hashes[hash] = base64.b32encode(hashes[hash].finish()).rstrip('=')
         # TODO: Why len(self.pieces) < 2 ?
         if len(self.hashes.pieces) < 2: self.hashes.pieces = []
+        # Remember the hashes, unless the file was changed while scanning it
+        if cache and cache.key(os.stat(filename)) == cache.key(st):
+            computed = dict((hash, self.hashes[hash]) for hash in 'ed2k md5 sha1 sha256 aich tth'.split() if hashes[hash == 'ed2k' and 'md4' or hash])
+            cache.put(st, computed, use_chunks and self.hashes.piecelength or 0, self.hashes.pieces)
         # Convert to string
         self.hashes.piecelength = str(self.hashes.piecelength)
         if verbose: print "done"
@@ -757,16 +1165,16 @@ class Metafile(object):
 
     def generate_file(self, add_p2p=True):
         if self.filename.strip() != "":
-            text = '    <file name="' + self.filename + '">' + os.linesep
+            text = ['    <file name="' + self.filename + '">' + os.linesep]
         else:
-            text = '    <file>' + os.linesep
+            text = ['    <file>' + os.linesep]
         # File info
         # TODO: relations
         for attr in 'identity size version language os changelog description logo mimetype releasedate screenshot upgrade'.split():
             if "" != getattr(self, attr).strip():
-                text += "      <%s>%s</%s>%s" % (attr, escape(getattr(self, attr)), attr, os.linesep)
+                text.append("      <%s>%s</%s>%s" % (attr, escape(getattr(self, attr)), attr, os.linesep))
         if self.tags:
-            text += '      <tags>' + ','.join(unique(self.tags)) + "</tags>" + os.linesep
+            text.append('      <tags>' + ','.join(unique(self.tags)) + "</tags>" + os.linesep)
 
         # Add mirrors
         for url, type, location, preference in self.mirrors.mirrors:
@@ -775,10 +1183,10 @@ class Metafile(object):
                 url += os.path.basename(self.filename)
             self.add_url(url, type, location, preference)
 
-        text += generate_verification_and_resources(self, add_p2p, self.get_protocols())
+        text.append(generate_verification_and_resources(self, add_p2p, self.get_protocols()))
 
-        text += '    </file>' + os.linesep
-        return text
+        text.append('    </file>' + os.linesep)
+        return ''.join(text)
 
     # Return list of found resource types
     def get_protocols(self):
@@ -965,6 +1373,43 @@ class Metalink(object):
         return self.file.validate_url(url)
 
     def generate(self, filename='', add_p2p=True):
+        if filename:
+            _filename = filename
+            if filename is True:
+                filename = (self.filename_absolute or self.file.filename) + '.metalink'
+            # Create backup
+            if os.path.isfile(filename) and not _opts['overwrite']:
+                filename += '.new'
+                # os.rename(filename, filename + '.bak')
+            # Write to a temporary file, so a failure keeps the old file
+            fp = open(filename + '.tmp', "wb")
+            try:
+                self.write(fp, _filename, add_p2p)
+            except:
+                fp.close()
+                os.remove(filename + '.tmp')
+                raise
+            fp.close()
+            os.rename(filename + '.tmp', filename)
+            print 'Generated:', filename
+
+            if _opts['create_torrent']:
+                torrent = filename.endswith('.new') and filename[:-4] or filename
+                torrent = (torrent.endswith('.metalink') and torrent[:-9] or torrent) + '.torrent'
+                if os.path.isfile(torrent) and not _opts['overwrite']:
+                    torrent += '.new'
+                _errors = self.create_torrent(_opts['create_torrent'], torrent)
+                if _errors:
+                    print 'ERROR while generating %s:\n%s' % (torrent, "\n".join(_errors))
+            return True
+
+        from cStringIO import StringIO
+        fp = StringIO()
+        self.write(fp, filename, add_p2p)
+        return fp.getvalue()
+
+    def write(self, fp, filename='', add_p2p=True):
+        '''Write the UTF-8 encoded metalink to the file-like object fp, one <file> element at a time'''
         text = '<?xml version="1.0" encoding="utf-8"?>' + os.linesep
         origin = ""
         if self.url_prefix:
@@ -993,43 +1438,13 @@ class Metalink(object):
         text += "  <files>" + os.linesep
         # Add multi-file torrent information
         text += generate_verification_and_resources(self, add_p2p, [], False)
-        text_start = text
-        text_end = '  </files>' + os.linesep
-        text_end += '</metalink>'
+        fp.write(encode_utf8(text))
 
-        text_files = ''
         for f in self.files:
-            text = f.generate_file(add_p2p)
-            text_files += text
+            fp.write(encode_utf8(f.generate_file(add_p2p)))
             # TODO: Save separate .metalink for multi-file metalinks
-        text = text_start + text_files + text_end
 
-        try:
-            data = text.encode('utf-8')
-        except:
-            data = text.decode('latin1').encode('utf-8')
-        if filename:
-            if filename is True:
-                filename = (self.filename_absolute or self.file.filename) + '.metalink'
-            # Create backup
-            if os.path.isfile(filename) and not _opts['overwrite']:
-                filename += '.new'
-                # os.rename(filename, filename + '.bak')
-            fp = open(filename, "wb")
-            fp.write(data)
-            fp.close()
-            print 'Generated:', filename
-
-            if _opts['create_torrent']:
-                torrent = filename.endswith('.new') and filename[:-4] or filename
-                torrent = (torrent.endswith('.metalink') and torrent[:-9] or torrent) + '.torrent'
-                if os.path.isfile(torrent) and not _opts['overwrite']:
-                    torrent += '.new'
-                _errors = self.create_torrent(_opts['create_torrent'], torrent)
-                if _errors:
-                    print 'ERROR while generating %s:\n%s' % (torrent, "\n".join(_errors))
-            return True
-        return data
+        fp.write(encode_utf8('  </files>' + os.linesep + '</metalink>'))
 
     def generate_info(self):
         text = ""
@@ -1108,7 +1523,7 @@ class Metalink(object):
                         # TODO: Support the rest of allowed hash types: md4 sha384 sha512 rmd160 tiger crc32
                         if hash in verification.childNodes:
                             if hash.hasAttribute("type"):
-                                if hash.getAttribute("type").lower() in "ed2k md5 sha1 sha256".split():
+                                if hash.getAttribute("type").lower() in "ed2k md5 sha1 sha256 aich tth".split():
                                     self.file.hashes[hash.getAttribute("type").lower()] = self.get_text(hash).lower()
                     pieces = self.get_tag(verification, "pieces")
                     if pieces is not None:
@@ -1566,16 +1981,25 @@ class Torrent(object):
         else:
             raise TypeError('Unsupported data type to bencode: %s' % t.__name__)
 
+# Country codes and locations of known mirror domains, shared by all
+# Mirrors instances
+MIRROR_LOCATIONS = frozenset("af ax al dz as ad ao ai aq ag ar am aw au at az bs bh bd bb by be bz bj bm bt bo ba bw bv br io bn bg bf bi kh cm ca cv ky cf td cl cn cx cc co km cg cd ck cr ci hr cu cy cz dk dj dm do ec eg sv gq er ee et fk fo fj fi fr gf pf tf ga gm ge de gh gi gr gl gd gu gt gg gn gw gy ht hm va hn hk hu is in id ir iq ie im il it jm jp je jo kz ke ki kp kr kw kg la lv lb ls lr ly li lt lu mo mk mg mw my mv ml mt mh mq mr mu yt mx fm md mc mn me ms ma mz mm na nr np nl an nc nz ni ne ng nu nf mp no om pk pw ps pa pg py pe ph pn pl pt pr qa re ro ru rw sh kn lc pm vc ws sm st sa sn rs sc sl sg sk si sb so za gs es lk sd sr sj sz se ch sy tw tj tz th tl tg tk to tt tn tr tm tc tv ug ua ae gb us um uy uz vu ve vn vg vi wf eh ye zm zw".split())
+MIRROR_DOMAINS = {'ovh.net':'fr', 'clarkson.edu':'us', 'yousendit.com':'us', 'lunarpages.com':'us', 'kgt.org':'de', 'vt.edu':'us', 'lupaworld.com':'cn', 'pdx.edu':'us', 'mainseek.com':'pl', 'vmmatrix.net':'cn', 'mirrormax.net':'us', 'cn99.com':'cn', 'anl.gov':'us', 'mirrorservice.org':'gb', 'oleane.net':'fr', 'proxad.net':'fr', 'osuosl.org':'us', 'telia.net':'dk', 'mtu.edu':'us', 'utah.edu':'us', 'oakland.edu':'us', 'calpoly.edu':'us', 'supp.name':'cz', 'wayne.edu':'us', 'tummy.com':'us', 'dotsrc.org':'dk', 'ubuntu.com':'sp', 'wmich.edu':'us', 'smenet.org':'us', 'bay13.net':'de', 'saix.net':'za', 'vlsm.org':'id', 'ac.uk':'gb', 'optus.net':'au', 'esat.net':'ie', 'unrealradio.org':'us', 'dudcore.net':'us', 'filearena.net':'au', 'ale.org':'us', 'linux.org':'se', 'ipacct.com':'bg', 'planetmirror.com':'au', 'tds.net':'us', 'ac.yu':'sp', 'stealer.net':'de', 'co.uk':'gb', 'iu.edu':'us', 'jtlnet.com':'us', 'umn.edu':'us', 'rfc822.org':'de', 'opensourcemirrors.org':'us', 'xmission.com':'us', 'xtec.net':'es', 'nullnet.org':'us', 'ubuntu-es.org':'es', 'roedu.net':'ro', 'mithril-linux.org':'jp', 'gatech.edu':'us', 'ibiblio.org':'us', 'kangaroot.net':'be', 'comactivity.net':'se', 'prolet.org':'bg', 'actuatechina.com':'cn', 'areum.biz':'kr', 'daum.net':'kr', 'daum.net':'kr', 'calvin.edu':'us', 'columbia.edu':'us', 'crazeekennee.com':'us', 'buffalo.edu':'us', 'uta.edu':'us', 'software-mirror.com':'us', 'optusnet.dl.sourceforge.net':'au', 'belnet.dl.sourceforge.net':'be', 'ufpr.dl.sourceforge.net':'br', 'puzzle.dl.sourceforge.net':'ch', 'switch.dl.sourceforge.net':'ch', 'dfn.dl.sourceforge.net':'de', 'mesh.dl.sourceforge.net':'de', 'ovh.dl.sourceforge.net':'fr', 'heanet.dl.sourceforge.net':'ie', 'garr.dl.sourceforge.net':'it', 'jaist.dl.sourceforge.net':'jp', 'surfnet.dl.sourceforge.net':'nl', 'nchc.dl.sourceforge.net':'tw', 'kent.dl.sourceforge.net':'uk', 'easynews.dl.sourceforge.net':'us', 'internap.dl.sourceforge.net':'us', 'superb-east.dl.sourceforge.net':'us', 'superb-west.dl.sourceforge.net':'us', 'umn.dl.sourceforge.net':'us'}
+
 class Mirrors(object):
+    # Tables shared by all instances, which must not be modified
+    locations = MIRROR_LOCATIONS
+    domains = MIRROR_DOMAINS
+    search_link = re.compile(r'((?:(ftps?|https?|rsync|ed2k)://|(magnet):\?)[^" <>\r\n]+)')
+    search_links = re.compile(r'((?:(?:ftps?|https?|rsync|ed2k)://|magnet:\?)[^" <>\r\n]+)')
+    search_location = re.compile(r'(?:ftps?|https?|rsync)://([^/]*?([^./]+\.([^./]+)))/')
+    search_btih = re.compile(r'xt=urn:btih:[a-zA-Z0-9]{32}')
+
     def __init__(self, filename='', url=''):
         self.filename = filename
         self.url = url
-        self.locations = "af ax al dz as ad ao ai aq ag ar am aw au at az bs bh bd bb by be bz bj bm bt bo ba bw bv br io bn bg bf bi kh cm ca cv ky cf td cl cn cx cc co km cg cd ck cr ci hr cu cy cz dk dj dm do ec eg sv gq er ee et fk fo fj fi fr gf pf tf ga gm ge de gh gi gr gl gd gu gt gg gn gw gy ht hm va hn hk hu is in id ir iq ie im il it jm jp je jo kz ke ki kp kr kw kg la lv lb ls lr ly li lt lu mo mk mg mw my mv ml mt mh mq mr mu yt mx fm md mc mn me ms ma mz mm na nr np nl an nc nz ni ne ng nu nf mp no om pk pw ps pa pg py pe ph pn pl pt pr qa re ro ru rw sh kn lc pm vc ws sm st sa sn rs sc sl sg sk si sb so za gs es lk sd sr sj sz se ch sy tw tj tz th tl tg tk to tt tn tr tm tc tv ug ua ae gb us um uy uz vu ve vn vg vi wf eh ye zm zw".split()
-        self.search_link = re.compile(r'((?:(ftps?|https?|rsync|ed2k)://|(magnet):\?)[^" <>\r\n]+)')
-        self.search_links = re.compile(r'((?:(?:ftps?|https?|rsync|ed2k)://|magnet:\?)[^" <>\r\n]+)')
-        self.search_location = re.compile(r'(?:ftps?|https?|rsync)://([^/]*?([^./]+\.([^./]+)))/')
-        self.search_btih = re.compile(r'xt=urn:btih:[a-zA-Z0-9]{32}')
-        self.domains = {'ovh.net':'fr', 'clarkson.edu':'us', 'yousendit.com':'us', 'lunarpages.com':'us', 'kgt.org':'de', 'vt.edu':'us', 'lupaworld.com':'cn', 'pdx.edu':'us', 'mainseek.com':'pl', 'vmmatrix.net':'cn', 'mirrormax.net':'us', 'cn99.com':'cn', 'anl.gov':'us', 'mirrorservice.org':'gb', 'oleane.net':'fr', 'proxad.net':'fr', 'osuosl.org':'us', 'telia.net':'dk', 'mtu.edu':'us', 'utah.edu':'us', 'oakland.edu':'us', 'calpoly.edu':'us', 'supp.name':'cz', 'wayne.edu':'us', 'tummy.com':'us', 'dotsrc.org':'dk', 'ubuntu.com':'sp', 'wmich.edu':'us', 'smenet.org':'us', 'bay13.net':'de', 'saix.net':'za', 'vlsm.org':'id', 'ac.uk':'gb', 'optus.net':'au', 'esat.net':'ie', 'unrealradio.org':'us', 'dudcore.net':'us', 'filearena.net':'au', 'ale.org':'us', 'linux.org':'se', 'ipacct.com':'bg', 'planetmirror.com':'au', 'tds.net':'us', 'ac.yu':'sp', 'stealer.net':'de', 'co.uk':'gb', 'iu.edu':'us', 'jtlnet.com':'us', 'umn.edu':'us', 'rfc822.org':'de', 'opensourcemirrors.org':'us', 'xmission.com':'us', 'xtec.net':'es', 'nullnet.org':'us', 'ubuntu-es.org':'es', 'roedu.net':'ro', 'mithril-linux.org':'jp', 'gatech.edu':'us', 'ibiblio.org':'us', 'kangaroot.net':'be', 'comactivity.net':'se', 'prolet.org':'bg', 'actuatechina.com':'cn', 'areum.biz':'kr', 'daum.net':'kr', 'daum.net':'kr', 'calvin.edu':'us', 'columbia.edu':'us', 'crazeekennee.com':'us', 'buffalo.edu':'us', 'uta.edu':'us', 'software-mirror.com':'us', 'optusnet.dl.sourceforge.net':'au', 'belnet.dl.sourceforge.net':'be', 'ufpr.dl.sourceforge.net':'br', 'puzzle.dl.sourceforge.net':'ch', 'switch.dl.sourceforge.net':'ch', 'dfn.dl.sourceforge.net':'de', 'mesh.dl.sourceforge.net':'de', 'ovh.dl.sourceforge.net':'fr', 'heanet.dl.sourceforge.net':'ie', 'garr.dl.sourceforge.net':'it', 'jaist.dl.sourceforge.net':'jp', 'surfnet.dl.sourceforge.net':'nl', 'nchc.dl.sourceforge.net':'tw', 'kent.dl.sourceforge.net':'uk', 'easynews.dl.sourceforge.net':'us', 'internap.dl.sourceforge.net':'us', 'superb-east.dl.sourceforge.net':'us', 'superb-west.dl.sourceforge.net':'us', 'umn.dl.sourceforge.net':'us'}
+        # Locations of domains learned from parsed links, created on first use
+        self.learned_domains = None
         self.mirrors = []
         self.urls = []
 
@@ -1623,12 +2047,15 @@ class Mirrors(object):
             group = m.groups()
             if group[2] in self.locations:
                 return group[2]
-            if group[1] in self.domains:
-                return self.domains[group[1]]
-            if group[0] in self.domains:
-                return self.domains[group[0]]
+            for domain in group[1], group[0]:
+                if domain in self.domains:
+                    return self.domains[domain]
+                if self.learned_domains and domain in self.learned_domains:
+                    return self.learned_domains[domain]
             if location:
-                self.domains[group[1]] = location
+                if self.learned_domains is None:
+                    self.learned_domains = {}
+                self.learned_domains[group[1]] = location
                 return location
             #print 'Country unknown for:', group[0]
         return ''
@@ -1681,16 +2108,18 @@ class Mirrors(object):
         self.urls = [mirror[0] for mirror in self.mirrors]
 
 class Hashes(object):
+    search_hashes = re.compile(r"^(([a-z0-9]{32,64})\s+(?:\?(AICH|BTIH|EDONKEY|SHA1|SHA256))?\*?([^\r\n]+))", re.MULTILINE)
+    # aich=ED2K AICH hash, btih=BitTorrent infohash (= magnet:?xt=urn:btih link), tth=Tiger Tree root hash
+    verification_hashes = 'md4 md5 sha1 sha256 sha384 sha512 rmd160 tiger crc32 btih ed2k aich tth'
+    known_hashes = frozenset(verification_hashes.split())
+
     def __init__(self, filename='', url=''):
         self.filename = ''
         self.filename_absolute = ''
         self.set_file(filename)
         self.url = url
-        self.search_hashes = r"^(([a-z0-9]{32,64})\s+(?:\?(AICH|BTIH|EDONKEY|SHA1|SHA256))?\*?([^\r\n]+))"
-        # aich=ED2K AICH hash, btih=BitTorrent infohash (= magnet:?xt=urn:btih link)
-        self.verification_hashes = 'md4 md5 sha1 sha256 sha384 sha512 rmd160 tiger crc32 btih ed2k aich'
+        # Dict of file names and hashes for every hash type found so far
         self.hashes = {}
-        self.init()
         self.last_hash_file = ''
         self.pieces = []
         self.piecelength = 0
@@ -1700,8 +2129,11 @@ class Hashes(object):
     def init(self):
         self.pieces = []
         self.hashes = {}
-        for hash in self.verification_hashes.split():
+
+    def set_hash(self, hash, name, value):
+        if hash not in self.hashes:
             self.hashes[hash] = {}
+        self.hashes[hash][name] = value
 
     def set_file(self, filename):
         if not filename.strip():
@@ -1728,7 +2160,7 @@ class Hashes(object):
             return 0
 
         count = 0
-        for line, hash, type, name in re.findall(self.search_hashes, data, re.MULTILINE):
+        for line, hash, type, name in self.search_hashes.findall(data):
             name = name.strip()
             if filter_name and filter_name != name:
                 continue
@@ -1740,13 +2172,13 @@ class Hashes(object):
                         if len(hash) != length:
                             print 'Invalid %s hash: %s' % (type, line.strip())
                         elif not force_type or force_type.upper() == _type:
-                            self.hashes[_type.lower()][name] = hash
+                            self.set_hash(_type.lower(), name, hash)
                             count += 1
                         break
             else:
                 for _type, length in {'md5':32, 'sha1':40, 'sha256':64}.items():
                     if len(hash) == length and not force_type or force_type.lower() == _type:
-                        self.hashes[_type][name] = hash
+                        self.set_hash(_type, name, hash)
                         count += 1
                         break
         return count
@@ -1891,7 +2323,10 @@ class Hashes(object):
         self.remove(hash)
 
     def __setitem__(self, hash, value):
-        self.hashes[hash.lower()][self.filename or len(self.hashes[hash])] = value
+        hash = hash.lower()
+        if hash not in self.known_hashes:
+            raise KeyError(hash)
+        self.set_hash(hash, self.filename or len(self.hashes.get(hash, ())), value)
 
     def __contains__(self, hash):
         return self.has(hash)
@@ -2077,7 +2512,7 @@ class OptParser(object):
                     elif required and j == _len - 1 and i < length - 1 and (0 == len(args[i+1]) or '-' != args[i+1][0]):
                         value = self.parseValue(args[i+1], is_bool, not default)
                         skip = True
-                    if 1 == required and is_bool(value) and not is_bool:
+                    if 1 == required and isinstance(value, bool) and not is_bool:
                         self.addError("-%s requires a value" % opt)
                     else:
                         for option in _opt['options']:
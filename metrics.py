@@ -0,0 +1,137 @@
+#!/bin/python2
+
+# Run metrics: wall time per phase, counters, gauges and latency
+# histograms, written at the end of a run as JSON or in the Prometheus
+# text format (e.g. for node_exporter's textfile collector).
+
+import json, os, threading, time
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram(object):
+	def __init__(self, buckets = BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * len(buckets)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		for i, bound in enumerate(self.buckets):
+			if value <= bound:
+				self.counts[i] += 1
+				break
+		self.sum += value
+		self.count += 1
+
+	# Cumulative (upper bound, count) pairs, ending with +Inf
+	def cumulative(self):
+		result = []
+		total = 0
+		for bound, count in zip(self.buckets, self.counts):
+			total += count
+			result.append((bound, total))
+		result.append((float('inf'), self.count))
+		return result
+
+class Metrics(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.phases = {}
+		self.phase_order = []
+		self.counters = {}
+		self.gauges = {}
+		self.histograms = {}
+
+	# Add the wall time of the with block to the named phase. Phases
+	# which run in several threads at once (such as the accounts of a
+	# batch run) add up their times.
+	@contextmanager
+	def phase(self, name):
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.add_phase(name, time.time() - start)
+
+	def add_phase(self, name, seconds):
+		with self.lock:
+			if name not in self.phases:
+				self.phase_order.append(name)
+				self.phases[name] = 0.0
+			self.phases[name] += seconds
+
+	def count(self, name, n = 1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def set(self, name, value):
+		with self.lock:
+			self.gauges[name] = value
+
+	def observe(self, name, value):
+		with self.lock:
+			if name not in self.histograms:
+				self.histograms[name] = Histogram()
+			self.histograms[name].observe(value)
+
+	# Time the with block into the named histogram
+	@contextmanager
+	def timer(self, name):
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.observe(name, time.time() - start)
+
+	def as_dict(self):
+		with self.lock:
+			return {
+				'phases': [{'phase': name, 'seconds': round(self.phases[name], 6)} for name in self.phase_order],
+				'counters': dict(self.counters),
+				'gauges': dict(self.gauges),
+				'histograms': dict((name, {
+					'buckets': [['+Inf' if bound == float('inf') else bound, count] for bound, count in histogram.cumulative()],
+					'sum': round(histogram.sum, 6),
+					'count': histogram.count,
+				}) for name, histogram in self.histograms.items()),
+			}
+
+	def prometheus(self, prefix = 'metahumble'):
+		def number(value):
+			return '+Inf' if value == float('inf') else str(value)
+
+		data = self.as_dict()
+		lines = []
+		lines.append('# HELP %s_phase_seconds Wall time spent in each phase of the run' % prefix)
+		lines.append('# TYPE %s_phase_seconds gauge' % prefix)
+		for phase in data['phases']:
+			lines.append('%s_phase_seconds{phase="%s"} %s' % (prefix, phase['phase'], number(phase['seconds'])))
+		for name in sorted(data['counters']):
+			lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+			lines.append('%s_%s_total %s' % (prefix, name, number(data['counters'][name])))
+		for name in sorted(data['gauges']):
+			lines.append('# TYPE %s_%s gauge' % (prefix, name))
+			lines.append('%s_%s %s' % (prefix, name, number(data['gauges'][name])))
+		with self.lock:
+			histograms = sorted(self.histograms.items())
+			for name, histogram in histograms:
+				lines.append('# TYPE %s_%s histogram' % (prefix, name))
+				for bound, count in histogram.cumulative():
+					lines.append('%s_%s_bucket{le="%s"} %d' % (prefix, name, number(bound), count))
+				lines.append('%s_%s_sum %s' % (prefix, name, number(histogram.sum)))
+				lines.append('%s_%s_count %d' % (prefix, name, histogram.count))
+		return '\n'.join(lines) + '\n'
+
+	# Both writers replace the file atomically, so that collectors never
+	# see a partial file
+	def write_json(self, filename):
+		with open(filename + '.tmp', 'w') as f:
+			json.dump(self.as_dict(), f, indent=1, separators=(',', ': '), sort_keys=True)
+		os.rename(filename + '.tmp', filename)
+
+	def write_prometheus(self, filename):
+		with open(filename + '.tmp', 'w') as f:
+			f.write(self.prometheus())
+		os.rename(filename + '.tmp', filename)
@@ -0,0 +1,92 @@
+#!/bin/python2
+
+# Planning of downloads: comparison of a generated metalink with the
+# contents of a download directory, to find the files which still need
+# to be downloaded.
+#
+# Files are compared by size first. Files of the right size are hashed
+# only if they have not been hashed before with the same size and
+# modification time; the results are remembered in DIR/hb.verified.
+
+import json, os, os.path
+
+import verifier
+
+def load_verified(filename):
+	if not os.path.exists(filename):
+		return {}
+	with open(filename) as f:
+		return json.load(f)['files']
+
+def save_verified(filename, verified):
+	with open(filename + '.tmp', 'w') as f:
+		json.dump({'version': 1, 'files': verified}, f)
+	os.rename(filename + '.tmp', filename)
+
+# Runs in a worker process; returns (filename, md5)
+def hash_file(task):
+	filename, path = task
+	try:
+		return filename, verifier.file_md5(path)
+	except (IOError, OSError):
+		return filename, None
+
+# Compare the files of the metalink.Metalink m with dl_dir. Returns a
+# list of (metafile, status) tuples for the files that need to be
+# downloaded, where status is 'missing', 'truncated' or 'changed'.
+# Without check_hashes, files of the right size are assumed to be
+# correct. Files are hashed by a pool of jobs processes (default: one
+# per CPU).
+def plan(m, dl_dir, check_hashes = True, jobs = None):
+	import multiprocessing
+
+	verified_fn = os.path.join(dl_dir, 'hb.verified')
+	verified = load_verified(verified_fn)
+
+	work = []
+	to_hash = []
+	stats = {}
+	for f in m.files:
+		filename = os.path.basename(f.filename)
+		path = os.path.join(dl_dir, filename)
+		size = int(f.size) if f.size else None
+		md5 = f.hashes['md5'].lower()
+		if not os.path.isfile(path):
+			work.append((f, 'missing'))
+			continue
+		st = os.stat(path)
+		if size is not None and st.st_size < size:
+			work.append((f, 'truncated'))
+		elif size is not None and st.st_size > size:
+			work.append((f, 'changed'))
+		elif check_hashes and md5:
+			entry = verified.get(filename)
+			if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+				to_hash.append((filename, path))
+				stats[filename] = (st.st_size, st.st_mtime)
+			elif entry['md5'] != md5:
+				work.append((f, 'changed'))
+
+	if to_hash:
+		hashed = {}
+		pool = multiprocessing.Pool(jobs)
+		try:
+			for filename, result in pool.imap_unordered(hash_file, to_hash):
+				hashed[filename] = result
+				if result is not None:
+					size, mtime = stats[filename]
+					verified[filename] = {'size': size, 'mtime': mtime, 'md5': result}
+		finally:
+			pool.terminate()
+		names = set(os.path.basename(f.filename) for f in m.files)
+		save_verified(verified_fn, dict((filename, entry) for filename, entry in verified.items() if filename in names))
+
+		for f in m.files:
+			filename = os.path.basename(f.filename)
+			if filename in hashed and hashed[filename] != f.hashes['md5'].lower():
+				work.append((f, 'changed'))
+
+	# Keep the order of the metalink
+	order = dict((id(f), i) for i, f in enumerate(m.files))
+	work.sort(key=lambda item: order[id(item[0])])
+	return work
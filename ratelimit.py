@@ -0,0 +1,137 @@
+#!/bin/python2
+
+# Client-side throttling of HumbleBundle API calls.
+#
+# Calls are spaced out by a token bucket (if a request rate is set), and
+# the number of calls in flight is adapted to the server: it grows by
+# one per round of successful calls, and is halved when the server
+# answers with 429 Too Many Requests or a 5xx error (AIMD). Throttled
+# calls and connection errors are retried after a jittered exponential
+# backoff, or after the time requested by a Retry-After header.
+
+import email.utils, random, threading, time
+
+# Seconds to wait according to a Retry-After header value (either a
+# number of seconds or an HTTP date), or None if it cannot be parsed
+def parse_retry_after(value, now = None):
+	if not value:
+		return None
+	value = value.strip()
+	if value.isdigit():
+		return float(value)
+	date = email.utils.parsedate_tz(value)
+	if date is None:
+		return None
+	if now is None:
+		now = time.time()
+	return max(0.0, email.utils.mktime_tz(date) - now)
+
+# Delay before retry number attempt (counting from 0), picked at random
+# up to an exponentially growing bound ("full jitter")
+def backoff(attempt, base = 1.0, cap = 60.0):
+	return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class TokenBucket(object):
+	def __init__(self, rate, burst = 1):
+		self.rate = float(rate)
+		self.burst = burst
+		self.tokens = float(burst)
+		self.stamp = time.time()
+		self.lock = threading.Lock()
+
+	# Take a token, waiting until one is available. Tokens are reserved
+	# in order, so waiting callers are served first come, first served.
+	def acquire(self):
+		with self.lock:
+			now = time.time()
+			self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+			self.stamp = now
+			self.tokens -= 1
+			wait = -self.tokens / self.rate if self.tokens < 0 else 0
+		if wait:
+			time.sleep(wait)
+
+# Concurrency limit between minimum and maximum, adjusted by AIMD.
+# Several calls failing at once count as one decrease per cooldown.
+class AdaptiveLimit(object):
+	def __init__(self, maximum, minimum = 1, cooldown = 1.0):
+		self.maximum = maximum
+		self.minimum = minimum
+		self.cooldown = cooldown
+		self.limit = float(maximum)
+		self.active = 0
+		self.decreased = 0
+		self.cond = threading.Condition()
+
+	def acquire(self):
+		with self.cond:
+			while self.active >= int(self.limit):
+				self.cond.wait()
+			self.active += 1
+
+	def release(self, throttled = False):
+		with self.cond:
+			self.active -= 1
+			if throttled:
+				now = time.time()
+				if now - self.decreased >= self.cooldown:
+					self.limit = max(self.minimum, self.limit / 2)
+					self.decreased = now
+			else:
+				self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+			self.cond.notify_all()
+
+class Throttle(object):
+	def __init__(self, concurrency = 1, rate = None, retries = 5, base_delay = 1.0, max_delay = 60.0):
+		self.limit = AdaptiveLimit(max(concurrency, 1))
+		self.bucket = TokenBucket(rate, max(concurrency, 1)) if rate else None
+		self.retries = retries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.lock = threading.Lock()
+		self.calls = 0
+		self.retried = 0
+		self.throttled = 0
+
+	# Call fn(*args, **kwargs), retrying it on 429 and 5xx responses and
+	# on connection errors. Other errors are raised immediately.
+	def call(self, fn, *args, **kwargs):
+		import requests
+
+		attempt = 0
+		while True:
+			if self.bucket is not None:
+				self.bucket.acquire()
+			self.limit.acquire()
+			throttled = False
+			try:
+				with self.lock:
+					self.calls += 1
+				return fn(*args, **kwargs)
+			except requests.RequestException as e:
+				response = getattr(e, 'response', None)
+				status = response.status_code if response is not None else None
+				throttled = status == 429 or (status is not None and status >= 500)
+				if not (throttled or response is None) or attempt >= self.retries:
+					raise
+				delay = backoff(attempt, self.base_delay, self.max_delay)
+				if throttled:
+					retry_after = parse_retry_after(response.headers.get('Retry-After'))
+					if retry_after is not None:
+						delay = max(delay, retry_after)
+			finally:
+				self.limit.release(throttled)
+
+			with self.lock:
+				self.retried += 1
+				if throttled:
+					self.throttled += 1
+			time.sleep(delay)
+			attempt += 1
+
+	# Add the call statistics to a metrics.Metrics
+	def report(self, metrics):
+		metrics.count('api_calls', self.calls)
+		metrics.count('api_retries', self.retried)
+		metrics.count('api_throttled', self.throttled)
+		metrics.set('api_concurrency_limit', self.limit.limit)
@@ -0,0 +1,165 @@
+#!/bin/python2
+
+# Piece-level checking and repair of downloaded files, using the piece
+# hashes of a metalink (<pieces>, as written by metalink.py or taken
+# from a torrent).
+#
+# Pieces are hashed by a pool of processes, each reading its own range
+# of a file. Bad pieces are merged into byte ranges, which are fetched
+# again from the HTTP resources of the file and checked once more, so
+# that a few corrupt blocks do not cost a download of the whole file.
+
+import binascii, os, os.path
+
+import metalink
+
+# Number of pieces hashed by one task
+PIECES_PER_TASK = 16
+
+# (piecelength, piece hashes) of a metalink.Metafile, or None if it has
+# no usable piece hashes
+def piece_hashes(f):
+	if f.hashes.piecetype != 'sha1' or not f.hashes.pieces or not f.size:
+		return None
+	return int(f.hashes.piecelength), [piece.lower() for piece in f.hashes.pieces]
+
+# Merge sorted [start, end) ranges which touch or overlap
+def merge_ranges(ranges):
+	merged = []
+	for start, end in ranges:
+		if merged and start <= merged[-1][1]:
+			merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+		else:
+			merged.append((start, end))
+	return merged
+
+def overlaps(start, end, ranges):
+	return any(start < range_end and range_start < end for range_start, range_end in ranges)
+
+# Runs in a worker process; returns (path, start, digests), where
+# digests is None if the file could not be read
+def hash_pieces(task):
+	path, start, end, piecelength = task
+	try:
+		return path, start, metalink.hash_piece_range((path, start, end, piecelength, metalink.scan_buffer_size))
+	except (IOError, OSError):
+		return path, start, None
+
+# Hash the pieces of the metalink.Metafile files found in dl_dir, using a
+# pool of jobs processes (default: one per CPU). With only (a dict of
+# file names and byte ranges), only the pieces overlapping these ranges
+# are hashed. Returns a dict of the checked file names and their bad
+# byte ranges (empty if the file is OK). Missing pieces at the end of a
+# truncated file are bad.
+def check(files, dl_dir, jobs = None, only = None):
+	import multiprocessing
+
+	tasks = []
+	checked = {}
+	bad = {}
+	for f in files:
+		filename = os.path.basename(f.filename)
+		path = os.path.join(dl_dir, filename)
+		info = piece_hashes(f)
+		if info is None or not os.path.isfile(path) or (only is not None and filename not in only):
+			continue
+		piecelength, hashes = info
+		size = int(f.size)
+		checked[path] = (filename, piecelength, hashes, size)
+		bad[filename] = []
+		for first in range(0, len(hashes), PIECES_PER_TASK):
+			start = first * piecelength
+			end = min(size, (first + PIECES_PER_TASK) * piecelength)
+			if only is None or overlaps(start, end, only[filename]):
+				tasks.append((path, start, end, piecelength))
+
+	pool = multiprocessing.Pool(jobs)
+	try:
+		for path, start, digests in pool.imap_unordered(hash_pieces, tasks):
+			filename, piecelength, hashes, size = checked[path]
+			first = start / piecelength
+			count = min(PIECES_PER_TASK, len(hashes) - first)
+			for i in range(count):
+				start = (first + i) * piecelength
+				end = min(size, start + piecelength)
+				if only is not None and not overlaps(start, end, only[filename]):
+					continue
+				if digests is None or i >= len(digests) or binascii.hexlify(digests[i]) != hashes[first + i]:
+					bad[filename].append((start, end))
+	finally:
+		pool.terminate()
+
+	return dict((filename, merge_ranges(sorted(ranges))) for filename, ranges in bad.items())
+
+# Fetch the bad byte ranges of the metalink.Metafile f (as returned by
+# check) into its file in dl_dir, using a downloader.Downloader. The
+# file is cut or extended to its size first. Returns None, or the error
+# of a range which could not be fetched from any of the HTTP resources.
+def fetch_ranges(f, dl_dir, ranges, d):
+	import requests
+	import downloader
+
+	urls = [res.url for res in f.resources if res.type in ('http', 'https')]
+	if not urls:
+		return 'No HTTP URL'
+	with open(os.path.join(dl_dir, os.path.basename(f.filename)), 'r+b') as fp:
+		fp.truncate(int(f.size))
+		for index, (start, end) in enumerate(ranges):
+			error = None
+			for attempt in range(d.retries):
+				url = urls[(index + attempt) % len(urls)]
+				try:
+					fp.seek(start)
+					d.fetch_range(url, fp, start, end)
+					error = None
+					break
+				except (requests.RequestException, downloader.DownloadError, IOError) as e:
+					error = e
+			if error is not None:
+				return str(error)
+	return None
+
+# Check the files of the metalink.Metalink m in dl_dir, and repair their
+# bad pieces with the downloader.Downloader d (if given). Prints the
+# result for every file, and returns the list of files which are still
+# bad. Files which are not on disk are reported, but not counted as bad.
+def repair(m, dl_dir, d = None, jobs = None):
+	import verifier
+
+	files = dict((os.path.basename(f.filename), f) for f in m.files)
+	bad = check(m.files, dl_dir, jobs)
+	fetched = {}
+	repaired = {}
+	if d is not None:
+		for filename, ranges in sorted(bad.items()):
+			if ranges:
+				fetched[filename] = fetch_ranges(files[filename], dl_dir, ranges, d)
+		repaired = dict((filename, bad[filename]) for filename, error in fetched.items() if error is None)
+		if repaired:
+			bad.update(check(m.files, dl_dir, jobs, repaired))
+
+	failed = []
+	for filename in sorted(files):
+		f = files[filename]
+		path = os.path.join(dl_dir, filename)
+		if not os.path.isfile(path):
+			result = 'Not on disk'
+		elif filename not in bad:
+			result = 'No piece hashes'
+		elif fetched.get(filename):
+			result = fetched[filename]
+		elif bad[filename]:
+			result = 'Bad bytes ' + ', '.join('%d-%d' % (start, end - 1) for start, end in bad[filename])
+		elif filename in fetched:
+			md5 = f.hashes['md5'].lower()
+			result = 'Repaired %d bytes' % sum(end - start for start, end in repaired[filename])
+			if md5 and verifier.file_md5(path) != md5:
+				result += ', but bad md5sum'
+				failed.append(filename)
+		else:
+			result = 'OK'
+		if bad.get(filename) or fetched.get(filename):
+			failed.append(filename)
+		print(filename)
+		print(' >> ' + result)
+	return failed
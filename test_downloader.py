@@ -0,0 +1,187 @@
+#!/bin/python2
+
+# Tests of downloader.py against a local HTTP server which supports
+# Range requests.
+#
+# Usage: python2 -m unittest discover
+
+import BaseHTTPServer, SocketServer, hashlib, json, os, os.path, random, re, shutil, tempfile, threading, unittest
+
+import requests
+
+import downloader
+import metalink
+
+# Serves the files in root, and records the (path, start, end) of every
+# request, where end is exclusive
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		name = self.path.split('?')[0].lstrip('/')
+		path = os.path.join(self.server.root, name)
+		if not os.path.isfile(path):
+			self.send_response(404)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+		size = os.path.getsize(path)
+		start, end = 0, size
+		m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+		if m:
+			start = int(m.group(1))
+			end = int(m.group(2)) + 1 if m.group(2) else size
+			self.send_response(206)
+			self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+		else:
+			self.send_response(200)
+		self.server.requests.append((name, start, end))
+		self.send_header('Content-Length', str(end - start))
+		self.end_headers()
+		with open(path, 'rb') as f:
+			f.seek(start)
+			self.wfile.write(f.read(end - start))
+
+	def log_message(self, *args):
+		pass
+
+class RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, root):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), RangeHandler)
+		self.root = root
+		self.requests = []
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def url(self, name):
+		return 'http://127.0.0.1:%d/%s?ttl=1' % (self.server_address[1], name)
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+# Random contents of a file
+def random_data(size, seed = 0):
+	r = random.Random(seed)
+	return ''.join(chr(r.randrange(256)) for i in xrange(size))
+
+# A metalink.Metalink of the files in the dict contents, served by server
+def make_metalink(server, contents):
+	m = metalink.Metalink()
+	m.files = []
+	for name, data in sorted(contents.items()):
+		m.add_file()
+		m.file.filename = name
+		m.file.size = str(len(data))
+		m.file.hashes['md5'] = hashlib.md5(data).hexdigest()
+		m.file.add_url(server.url(name))
+	return m
+
+class ServerTestCase(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.serve_dir = os.path.join(self.dir, 'serve')
+		self.dl_dir = os.path.join(self.dir, 'dl')
+		os.mkdir(self.serve_dir)
+		os.mkdir(self.dl_dir)
+		self.server = RangeServer(self.serve_dir)
+
+	def tearDown(self):
+		self.server.stop()
+		shutil.rmtree(self.dir)
+
+	def serve(self, name, data):
+		with open(os.path.join(self.serve_dir, name), 'wb') as f:
+			f.write(data)
+
+	def read(self, name):
+		with open(os.path.join(self.dl_dir, name), 'rb') as f:
+			return f.read()
+
+class DownloaderTest(ServerTestCase):
+	SEGMENT_SIZE = 64 * 1024
+
+	def setUp(self):
+		ServerTestCase.setUp(self)
+		self.data = random_data(16 * self.SEGMENT_SIZE + 1000)
+		self.serve('big.bin', self.data)
+		self.serve('small.bin', 'small')
+		self.m = make_metalink(self.server, {'big.bin': self.data, 'small.bin': 'small'})
+		self.part = os.path.join(self.dl_dir, 'big.bin.part')
+
+	def downloader(self):
+		return downloader.Downloader(requests.Session(), 4, self.SEGMENT_SIZE, 3, 2 * self.SEGMENT_SIZE)
+
+	# Run download_metalink in a thread, so that a hang fails the test
+	def download(self):
+		results = []
+		thread = threading.Thread(target=lambda: results.append(self.downloader().download_metalink(self.m, self.dl_dir)))
+		thread.daemon = True
+		thread.start()
+		thread.join(60)
+		self.assertFalse(thread.is_alive(), 'download_metalink hangs')
+		return dict(results[0])
+
+	def write_part(self, data, done):
+		with open(self.part, 'wb') as f:
+			f.write(data)
+		with open(self.part + '.state', 'w') as f:
+			json.dump({'size': len(self.data), 'segment_size': self.SEGMENT_SIZE, 'done': done}, f)
+
+	def test_download(self):
+		self.assertEqual(self.download(), {'big.bin': 'OK', 'small.bin': 'OK'})
+		self.assertEqual(self.read('big.bin'), self.data)
+		self.assertEqual(self.read('small.bin'), 'small')
+		self.assertEqual(sorted(os.listdir(self.dl_dir)), ['big.bin', 'small.bin'])
+		ranges = sorted((start, end) for name, start, end in self.server.requests if name == 'big.bin')
+		self.assertEqual(len(ranges), 17)
+		self.assertEqual(ranges[-1], (16 * self.SEGMENT_SIZE, len(self.data)))
+
+	def test_complete_files_are_not_fetched(self):
+		self.download()
+		del self.server.requests[:]
+		self.assertEqual(self.download(), {'big.bin': 'OK', 'small.bin': 'OK'})
+		self.assertEqual(self.server.requests, [])
+
+	def test_resume(self):
+		# Segments 0, 1 and 5 are done; the rest of the file is garbage
+		done = [0, 1, 5]
+		data = bytearray(random_data(len(self.data), 1))
+		for index in done:
+			start = index * self.SEGMENT_SIZE
+			data[start:start + self.SEGMENT_SIZE] = self.data[start:start + self.SEGMENT_SIZE]
+		self.write_part(str(data), done)
+
+		self.assertEqual(self.download()['big.bin'], 'OK')
+		self.assertEqual(self.read('big.bin'), self.data)
+		self.assertFalse(os.path.exists(self.part + '.state'))
+		starts = set(start / self.SEGMENT_SIZE for name, start, end in self.server.requests if name == 'big.bin')
+		self.assertEqual(starts, set(range(17)) - set(done))
+
+	def test_resume_with_bad_segment(self):
+		self.write_part('\0' * len(self.data), [0])
+		result = self.download()['big.bin']
+		self.assertTrue(result.startswith('Bad md5sum'), result)
+		self.assertFalse(os.path.exists(self.part))
+		self.assertFalse(os.path.exists(self.part + '.state'))
+		self.assertEqual(self.download()['big.bin'], 'OK')
+		self.assertEqual(self.read('big.bin'), self.data)
+
+	def test_resume_from_truncated_part(self):
+		# The state of a part file of the wrong size is ignored
+		self.write_part(self.data[:self.SEGMENT_SIZE], [0])
+		self.assertEqual(self.download()['big.bin'], 'OK')
+		self.assertEqual(self.read('big.bin'), self.data)
+
+	def test_missing_file(self):
+		os.remove(os.path.join(self.serve_dir, 'small.bin'))
+		results = self.download()
+		self.assertEqual(results['big.bin'], 'OK')
+		self.assertNotEqual(results['small.bin'], 'OK')
+		self.assertFalse(os.path.exists(os.path.join(self.dl_dir, 'small.bin')))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,125 @@
+#!/bin/python2
+
+# Tests of the hash trees of metalink.py (AICH) and tiger.py (Tiger Tree
+# hashes).
+#
+# Usage: python2 -m unittest discover
+
+import base64, binascii, hashlib, os, shutil, tempfile, unittest
+
+import metalink
+import tiger
+
+PART = metalink.ed2k_part_size
+BLOCK = metalink.aich_block_size
+
+def base32(digest):
+	return base64.b32encode(digest).rstrip('=')
+
+# Deterministic contents of a file
+def sample_data(size):
+	return ''.join(hashlib.sha1(str(i)).digest() for i in xrange(size / 20 + 1))[:size]
+
+# Feed data to hash (an AICHHash or TigerTree) in blocks of block_size
+# bytes, at an offset in a larger buffer like metalink.read_blocks
+def feed(hash, data, block_size):
+	for start in range(0, len(data), block_size):
+		block = 'xx' + data[start:start + block_size]
+		hash.update(block, 2, len(block) - 2)
+	return hash.finish()
+
+# AICH root hash of data as defined by eMule (CAICHHashTree), computed
+# from the whole data: a node of more than one block is split into a
+# left and right subtree, where left branches get the larger half of the
+# ed2k parts (if the node is larger than a part) or of the blocks
+def reference_aich(data, is_left = True):
+	size = len(data)
+	if size <= BLOCK:
+		return hashlib.sha1(data).digest()
+	base = PART if size > PART else BLOCK
+	blocks = (size + base - 1) / base
+	left = ((blocks + 1 if is_left else blocks) / 2) * base
+	return hashlib.sha1(reference_aich(data[:left], True) + reference_aich(data[left:], False)).digest()
+
+def aich(data, block_size = 1024 * 1024):
+	return feed(metalink.AICHHash(len(data), hashlib.sha1()), data, block_size)
+
+class TigerTest(unittest.TestCase):
+	def test_tiger(self):
+		self.assertEqual(binascii.hexlify(tiger.tiger('')), '3293ac630c13f0245f92bbb1766e16167a4e58492dde73f3')
+		self.assertEqual(binascii.hexlify(tiger.tiger('abc')), '2aab1484e8c158f2bfb8c5ff41b57a525129131c957b5f93')
+
+	def tth(self, data, block_size = 4096):
+		return base32(feed(tiger.TigerTree(), data, block_size))
+
+	def test_tth(self):
+		self.assertEqual(self.tth(''), 'LWPNACQDBZRYXW3VHJVCJ64QBZNGHOHHHZWCLNQ')
+		self.assertEqual(self.tth('\0'), 'VK54ZIEEVTWNAUI5D5RDFIL37LX2IQNSTAXFKSA')
+		self.assertEqual(self.tth('A' * 1024), 'L66Q4YVNAFWVS23X2HJIRA5ZJ7WXR3F26RSASFA')
+		self.assertEqual(self.tth('A' * 1025), 'PZMRYHGY6LTBEH63ZWAHDORHSYTLO4LEFUIKHWY')
+
+	def test_tth_blocks(self):
+		# Leaves spanning several blocks, and an unbalanced tree
+		data = sample_data(5 * tiger.LEAF_SIZE + 100)
+		self.assertEqual(self.tth(data, 333), self.tth(data))
+		self.assertEqual(self.tth(data, 1), self.tth(data))
+
+class AICHTest(unittest.TestCase):
+	def test_below_one_block(self):
+		for size in (1, 1000, BLOCK):
+			data = sample_data(size)
+			self.assertEqual(aich(data), hashlib.sha1(data).digest())
+
+	def test_blocks(self):
+		data = sample_data(2 * BLOCK + 1)
+		# The left branch gets the larger half of the blocks
+		left = hashlib.sha1(hashlib.sha1(data[:BLOCK]).digest() + hashlib.sha1(data[BLOCK:2 * BLOCK]).digest()).digest()
+		self.assertEqual(aich(data), hashlib.sha1(left + hashlib.sha1(data[2 * BLOCK:]).digest()).digest())
+
+	def test_one_part(self):
+		data = sample_data(PART)
+		self.assertEqual(aich(data), reference_aich(data))
+		self.assertEqual(aich(data, 100000), reference_aich(data))
+
+	def test_one_byte_over_one_part(self):
+		data = sample_data(PART + 1)
+		root = hashlib.sha1(reference_aich(data[:PART]) + hashlib.sha1(data[PART:]).digest()).digest()
+		self.assertEqual(reference_aich(data), root)
+		self.assertEqual(aich(data), root)
+		self.assertEqual(aich(data, BLOCK + 1), root)
+
+	def test_zero_files(self):
+		# Files of zeros, e.g. head -c 9728000 /dev/zero
+		self.assertEqual(base32(aich('\0' * 1000)), 'YV37PI3WK4CTE5PT4PWMA3WCFZVZBE3G')
+		self.assertEqual(base32(aich('\0' * PART)), '5D3N4HQHIUMQ7IU7A5QLPLI6RHSWOR7B')
+		self.assertEqual(base32(aich('\0' * (PART + 1))), 'HL3TFXORIUEPXUWFPY3JLR7SMKGTO4IH')
+
+	def test_parts(self):
+		# Blocks do not cross the boundaries of parts, and the right
+		# branch of three parts gets one part
+		data = sample_data(2 * PART + BLOCK + 5)
+		self.assertEqual(aich(data), reference_aich(data))
+
+class ScanTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def scan(self, data, tth = False):
+		filename = os.path.join(self.dir, 'file.bin')
+		with open(filename, 'wb') as f:
+			f.write(data)
+		f = metalink.Metafile()
+		f.scan_file(filename, True, 255, 256, None, 64 * 1024, False, False, 0, tth)
+		return f.hashes
+
+	def test_scan(self):
+		data = sample_data(BLOCK + 10)
+		hashes = self.scan(data, True)
+		self.assertEqual(hashes['aich'], base32(reference_aich(data)))
+		self.assertEqual(hashes['tth'], base32(feed(tiger.TigerTree(), data, len(data))))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,140 @@
+#!/bin/python2
+
+# Tests of the order handling of metahumble.py, without the HumbleBundle
+# API.
+#
+# Usage: python2 -m unittest discover
+
+import json, os, os.path, shutil, tempfile, threading, time, unittest
+
+import metahumble
+
+class SharedRecordsTest(unittest.TestCase):
+	def test_fetched_once(self):
+		shared = metahumble.SharedRecords()
+		calls = []
+		def fetch(gamekey):
+			calls.append(gamekey)
+			time.sleep(0.05)
+			return {'gamekey': gamekey}
+
+		results = []
+		def account(gamekeys):
+			for gamekey in gamekeys:
+				results.append(shared.get(gamekey, fetch))
+		threads = [threading.Thread(target=account, args=(['key%d' % i for i in range(start, start + 5)],)) for start in (0, 0, 2, 3)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(sorted(calls), ['key%d' % i for i in range(8)])
+		self.assertEqual(len(results), 20)
+
+	def test_failed_fetch_is_retried(self):
+		shared = metahumble.SharedRecords()
+		started = threading.Event()
+		def fail(gamekey):
+			started.set()
+			time.sleep(0.05)
+			raise IOError('network blip')
+
+		errors = []
+		def first():
+			try:
+				shared.get('key', fail)
+			except IOError as e:
+				errors.append(e)
+		thread = threading.Thread(target=first)
+		thread.start()
+		started.wait()
+		self.assertEqual(shared.get('key', lambda gamekey: {'gamekey': gamekey}), {'gamekey': 'key'})
+		thread.join()
+		self.assertEqual(len(errors), 1)
+
+class CheckpointTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.dir, 'hb.checkpoint')
+		self.gamekeys = ['key%d' % i for i in range(4)]
+		self.fetched = []
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	# Fetch the records of all gamekeys with the checkpoint of the
+	# interrupted run; returns the records
+	def resume(self, max_age = None):
+		linker = metahumble.HumbleLinker()
+		def load_record(gamekey):
+			self.fetched.append(gamekey)
+			return {'gamekey': gamekey, 'run': 2}
+		linker.load_record = load_record
+		checkpoint = metahumble.Checkpoint(self.filename)
+		return list(linker.get_records(self.gamekeys, self.gamekeys, 1, None, checkpoint, max_age))
+
+	# Checkpoint the first two gamekeys, as fetched age seconds ago
+	def interrupt(self, age):
+		with open(self.filename, 'w') as f:
+			for gamekey in self.gamekeys[:2]:
+				f.write(json.dumps({'fetched': time.time() - age, 'record': {'gamekey': gamekey, 'run': 1}}) + '\n')
+
+	def test_resume(self):
+		self.interrupt(60)
+		records = self.resume()
+		self.assertEqual([record['run'] for record in records], [1, 1, 2, 2])
+		self.assertEqual(self.fetched, self.gamekeys[2:])
+
+	def test_add(self):
+		checkpoint = metahumble.Checkpoint(self.filename)
+		checkpoint.add({'gamekey': 'key0', 'run': 1})
+		checkpoint.file.close()
+		checkpoint = metahumble.Checkpoint(self.filename)
+		self.assertEqual(checkpoint.records, {'key0': {'gamekey': 'key0', 'run': 1}})
+		self.assertEqual(checkpoint.fresh(), set(['key0']))
+		checkpoint.remove()
+		self.assertFalse(os.path.exists(self.filename))
+
+	def test_old_checkpoint_is_not_resumed(self):
+		self.interrupt(7 * 24 * 60 * 60)
+		records = self.resume()
+		self.assertEqual([record['run'] for record in records], [2, 2, 2, 2])
+		self.assertEqual(self.fetched, self.gamekeys)
+
+	def test_max_age(self):
+		self.interrupt(60 * 60)
+		self.resume(30 * 60)
+		self.assertEqual(self.fetched, self.gamekeys)
+
+	def test_incomplete_line(self):
+		self.interrupt(60)
+		with open(self.filename, 'ab') as f:
+			f.write('{"fetched": 1')
+		self.assertEqual(len(metahumble.Checkpoint(self.filename).records), 2)
+		with open(self.filename) as f:
+			self.assertTrue(f.read().endswith('\n'))
+
+class ReadAccountsTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.dir, 'accounts')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def read(self, text):
+		with open(self.filename, 'w') as f:
+			f.write(text)
+		return metahumble.read_accounts(self.filename)
+
+	def test_accounts(self):
+		self.assertEqual(self.read('# comment\n\na@example.com secret\nb@example.com pass word\n'), [('a@example.com', 'secret'), ('b@example.com', 'pass word')])
+		self.assertEqual(self.read('# none\n'), [])
+
+	def test_missing_password(self):
+		with self.assertRaises(ValueError) as cm:
+			self.read('a@example.com secret\nb@example.com\n')
+		self.assertIn(':2:', str(cm.exception))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,128 @@
+#!/bin/python2
+
+# Tests of repair.py against a local HTTP server which supports Range
+# requests.
+#
+# Usage: python2 -m unittest discover
+
+import hashlib, os, os.path, unittest
+
+import requests
+
+import downloader
+import repair
+from test_downloader import ServerTestCase, make_metalink, random_data
+
+PIECE_LENGTH = 16 * 1024
+
+def add_pieces(f, data):
+	f.hashes.piecetype = 'sha1'
+	f.hashes.piecelength = PIECE_LENGTH
+	f.hashes.pieces = [hashlib.sha1(data[start:start + PIECE_LENGTH]).hexdigest() for start in range(0, len(data), PIECE_LENGTH)]
+
+class RepairTest(ServerTestCase):
+	def setUp(self):
+		ServerTestCase.setUp(self)
+		self.data = random_data(10 * PIECE_LENGTH + 1000)
+		self.serve('file.bin', self.data)
+		self.m = make_metalink(self.server, {'file.bin': self.data})
+		add_pieces(self.m.files[0], self.data)
+		self.path = os.path.join(self.dl_dir, 'file.bin')
+
+	def write(self, data):
+		with open(self.path, 'wb') as f:
+			f.write(data)
+
+	# Overwrite length bytes at offset of the downloaded file
+	def corrupt(self, offset, length):
+		with open(self.path, 'r+b') as f:
+			f.seek(offset)
+			f.write('\0' * length)
+
+	def repair(self, fetch = True):
+		return repair.repair(self.m, self.dl_dir, downloader.Downloader(requests.Session(), 1) if fetch else None, 2)
+
+	def test_check(self):
+		self.write(self.data)
+		self.assertEqual(repair.check(self.m.files, self.dl_dir, 2), {'file.bin': []})
+
+	def test_check_corrupt_pieces(self):
+		self.write(self.data)
+		self.corrupt(2 * PIECE_LENGTH + 100, 10)
+		# Spans pieces 5 and 6, which are merged into one range
+		self.corrupt(6 * PIECE_LENGTH - 1, 2)
+		# The last, short piece
+		self.corrupt(len(self.data) - 1, 1)
+		self.assertEqual(repair.check(self.m.files, self.dl_dir, 2), {'file.bin': [
+			(2 * PIECE_LENGTH, 3 * PIECE_LENGTH),
+			(5 * PIECE_LENGTH, 7 * PIECE_LENGTH),
+			(10 * PIECE_LENGTH, len(self.data)),
+		]})
+
+	def test_check_truncated(self):
+		self.write(self.data[:4 * PIECE_LENGTH + 10])
+		self.assertEqual(repair.check(self.m.files, self.dl_dir, 2), {'file.bin': [(4 * PIECE_LENGTH, len(self.data))]})
+
+	def test_check_only(self):
+		self.write(self.data)
+		self.corrupt(0, 1)
+		self.corrupt(8 * PIECE_LENGTH, 1)
+		only = {'file.bin': [(7 * PIECE_LENGTH, 9 * PIECE_LENGTH)]}
+		self.assertEqual(repair.check(self.m.files, self.dl_dir, 2, only), {'file.bin': [(8 * PIECE_LENGTH, 9 * PIECE_LENGTH)]})
+
+	def test_check_only_does_not_fetch(self):
+		self.write(self.data)
+		self.corrupt(PIECE_LENGTH, 1)
+		self.assertEqual(self.repair(False), ['file.bin'])
+		self.assertEqual(self.server.requests, [])
+
+	def test_repair_corrupt_pieces(self):
+		self.write(self.data)
+		self.corrupt(2 * PIECE_LENGTH + 100, 10)
+		self.corrupt(6 * PIECE_LENGTH - 1, 2)
+		self.assertEqual(self.repair(), [])
+		self.assertEqual(self.read('file.bin'), self.data)
+		# Only the bad pieces were fetched again
+		self.assertEqual(sorted((start, end) for name, start, end in self.server.requests), [
+			(2 * PIECE_LENGTH, 3 * PIECE_LENGTH),
+			(5 * PIECE_LENGTH, 7 * PIECE_LENGTH),
+		])
+
+	def test_repair_truncated(self):
+		self.write(self.data[:3 * PIECE_LENGTH])
+		self.assertEqual(self.repair(), [])
+		self.assertEqual(self.read('file.bin'), self.data)
+		self.assertEqual([(start, end) for name, start, end in self.server.requests], [(3 * PIECE_LENGTH, len(self.data))])
+
+	def test_repair_too_long(self):
+		self.write(self.data + 'garbage')
+		self.corrupt(0, 1)
+		self.assertEqual(self.repair(), [])
+		self.assertEqual(self.read('file.bin'), self.data)
+
+	def test_repair_bad_md5(self):
+		# The pieces can be repaired, but the MD5 sum of the metalink is wrong
+		del self.m.files[0].hashes['md5']
+		self.m.files[0].hashes['md5'] = hashlib.md5('other').hexdigest()
+		self.write(self.data)
+		self.corrupt(0, 1)
+		self.assertEqual(self.repair(), ['file.bin'])
+		self.assertEqual(self.read('file.bin'), self.data)
+
+	def test_repair_unavailable(self):
+		os.remove(os.path.join(self.serve_dir, 'file.bin'))
+		self.write(self.data)
+		self.corrupt(0, 1)
+		self.assertEqual(self.repair(), ['file.bin'])
+		self.assertNotEqual(self.read('file.bin'), self.data)
+
+	def test_skipped_files(self):
+		# Files without piece hashes or not on disk are not bad
+		self.m.files[0].hashes.pieces = []
+		self.write('garbage')
+		self.assertEqual(self.repair(), [])
+		os.remove(self.path)
+		self.assertEqual(self.repair(), [])
+
+if __name__ == '__main__':
+	unittest.main()
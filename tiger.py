@@ -0,0 +1,127 @@
+#!/bin/python2
+
+# Tiger hash and Tiger Tree hash (TTH, as used by magnet links and
+# Direct Connect), in pure Python.
+#
+# The S boxes are not listed here, but generated on first use as in the
+# reference implementation by Anderson and Biham, which takes about a
+# second. Hashing is slow (below 1 MB/s), so tree hashes are only
+# computed on request.
+
+import struct
+
+MASK = 0xFFFFFFFFFFFFFFFF
+INITIAL_STATE = (0x0123456789ABCDEF, 0xFEDCBA9876543210, 0xF096A5B4C3B2E187)
+SBOX_SEED = "Tiger - A Fast New Hash Function, by Ross Anderson and Eli Biham"
+
+# Size of the leaves of Tiger Trees
+LEAF_SIZE = 1024
+
+_sboxes = None
+
+def compress(block, state, sboxes):
+	t1, t2, t3, t4 = sboxes
+	x = list(struct.unpack('<8Q', block))
+	a, b, c = state
+	for mul in (5, 7, 9):
+		if mul != 5:
+			# Key schedule
+			x[0] = (x[0] - (x[7] ^ 0xA5A5A5A5A5A5A5A5)) & MASK
+			x[1] ^= x[0]
+			x[2] = (x[2] + x[1]) & MASK
+			x[3] = (x[3] - (x[2] ^ ((~x[1] << 19) & MASK))) & MASK
+			x[4] ^= x[3]
+			x[5] = (x[5] + x[4]) & MASK
+			x[6] = (x[6] - (x[5] ^ ((~x[4] & MASK) >> 23))) & MASK
+			x[7] ^= x[6]
+			x[0] = (x[0] + x[7]) & MASK
+			x[1] = (x[1] - (x[0] ^ ((~x[7] << 19) & MASK))) & MASK
+			x[2] ^= x[1]
+			x[3] = (x[3] + x[2]) & MASK
+			x[4] = (x[4] - (x[3] ^ ((~x[2] & MASK) >> 23))) & MASK
+			x[5] ^= x[4]
+			x[6] = (x[6] + x[5]) & MASK
+			x[7] = (x[7] - (x[6] ^ 0x0123456789ABCDEF)) & MASK
+		# A pass of eight rounds, each of which rotates the roles of a, b
+		# and c; the next pass starts with the roles where this one ends
+		for xi in x:
+			c ^= xi
+			a = (a - (t1[c & 0xFF] ^ t2[(c >> 16) & 0xFF] ^ t3[(c >> 32) & 0xFF] ^ t4[(c >> 48) & 0xFF])) & MASK
+			b = ((b + (t4[(c >> 8) & 0xFF] ^ t3[(c >> 24) & 0xFF] ^ t2[(c >> 40) & 0xFF] ^ t1[c >> 56])) * mul) & MASK
+			a, b, c = b, c, a
+	return a ^ state[0], (b - state[1]) & MASK, (c + state[2]) & MASK
+
+def generate_sboxes():
+	table = [bytearray([i & 0xFF] * 8) for i in range(1024)]
+	state = INITIAL_STATE
+	abc = 2
+	for n in range(5):
+		for i in range(256):
+			for sbox in range(0, 1024, 256):
+				abc += 1
+				if abc == 3:
+					abc = 0
+					values = [struct.unpack('<Q', str(entry))[0] for entry in table]
+					state = compress(SBOX_SEED, state, (values[0:256], values[256:512], values[512:768], values[768:1024]))
+				column_bytes = bytearray(struct.pack('<Q', state[abc]))
+				for column in range(8):
+					j = sbox + column_bytes[column]
+					table[sbox + i][column], table[j][column] = table[j][column], table[sbox + i][column]
+	values = [struct.unpack('<Q', str(entry))[0] for entry in table]
+	return values[0:256], values[256:512], values[512:768], values[768:1024]
+
+def tiger(data):
+	"""Tiger/192 digest of the string data"""
+	global _sboxes
+	if _sboxes is None:
+		_sboxes = generate_sboxes()
+	length = len(data)
+	data += '\x01' + '\0' * ((55 - length) % 64) + struct.pack('<Q', length * 8)
+	state = INITIAL_STATE
+	for i in range(0, len(data), 64):
+		state = compress(data[i:i + 64], state, _sboxes)
+	return struct.pack('<3Q', *state)
+
+class TigerTree(object):
+	"""Tiger Tree hash (THEX) of the blocks passed to update (see
+	metalink.read_blocks). Complete subtrees are combined as soon as
+	possible, so only one hash per tree level is kept."""
+	def __init__(self):
+		self.leaf = ''
+		self.leaves = 0
+		# (level, digest) of the complete subtrees, largest first
+		self.stack = []
+
+	def add_leaf(self, data):
+		digest = tiger('\0' + data)
+		level = 0
+		while self.stack and self.stack[-1][0] == level:
+			digest = tiger('\x01' + self.stack.pop()[1] + digest)
+			level += 1
+		self.stack.append((level, digest))
+		self.leaves += 1
+
+	def update(self, data, offset, length):
+		pos = 0
+		if self.leaf:
+			pos = min(length, LEAF_SIZE - len(self.leaf))
+			self.leaf += str(buffer(data, offset, pos))
+			if len(self.leaf) < LEAF_SIZE:
+				return
+			self.add_leaf(self.leaf)
+			self.leaf = ''
+		while length - pos >= LEAF_SIZE:
+			self.add_leaf(str(buffer(data, offset + pos, LEAF_SIZE)))
+			pos += LEAF_SIZE
+		self.leaf = str(buffer(data, offset + pos, length - pos))
+
+	def finish(self):
+		"""Return the root digest. Unpaired subtrees are promoted to the
+		next level, so the remaining subtrees are combined from the right."""
+		if self.leaf or not self.leaves:
+			self.add_leaf(self.leaf)
+			self.leaf = ''
+		digest = self.stack[-1][1]
+		for level, left in reversed(self.stack[:-1]):
+			digest = tiger('\x01' + left + digest)
+		return digest
@@ -0,0 +1,135 @@
+#!/bin/python2
+
+# Verification of a download directory against a generated metalink
+# (formerly verify/verify.d).
+#
+# Files with a wrong size or MD5 sum are moved to old/<date>/bad (with
+# the reason recorded in descript.ion), and files which are not listed
+# in the metalink are moved to old/<date>/unknown.
+
+import hashlib, os, os.path, sys, time
+
+# Files maintained by metahumble itself, which are never unknown
+ignored_extensions = ('.metalink', '.index', '.aliases', '.checkpoint', '.verified', '.part', '.state', '.tmp')
+
+def file_md5(path):
+	md5 = hashlib.md5()
+	with open(path, 'rb') as f:
+		while True:
+			data = f.read(1024 * 1024)
+			if not data:
+				break
+			md5.update(data)
+	return md5.hexdigest()
+
+# Runs in a worker process; returns (filename, result)
+def check_file(task):
+	filename, path, size, md5, check_hashes = task
+	try:
+		if size and int(size) != os.path.getsize(path):
+			return filename, 'Bad size'
+		if check_hashes and md5:
+			result = file_md5(path)
+			if result != md5.lower():
+				return filename, 'Bad md5sum: Expected %s, got %s' % (md5.lower(), result)
+		# HB-provided SHA1s seem to be often wrong, so they are not checked.
+		# Support request #366674 submitted on Sun 2016-05-22 05:34 UTC
+	except (IOError, OSError) as e:
+		return filename, str(e)
+	return filename, 'OK'
+
+# Run function on the tasks, a list of (device, task) tuples, in the
+# multiprocessing.Pool pool, with at most per_device tasks of any device
+# at a time, so that the processes do not compete for one disk. Yields
+# the results in the order in which they are completed.
+def imap_by_device(pool, function, tasks, per_device = 1):
+	import Queue, threading
+
+	queues = {}
+	for device, task in tasks:
+		queues.setdefault(device, Queue.Queue()).put(task)
+	results = Queue.Queue()
+
+	def worker(queue):
+		while True:
+			try:
+				task = queue.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				results.put((True, pool.apply(function, (task,))))
+			except Exception as e:
+				results.put((False, e))
+
+	for queue in queues.values():
+		for i in range(min(per_device, queue.qsize())):
+			thread = threading.Thread(target=worker, args=(queue,))
+			thread.daemon = True
+			thread.start()
+
+	for i in range(len(tasks)):
+		ok, result = results.get()
+		if not ok:
+			raise result
+		yield result
+
+def move(path, directory):
+	if not os.path.exists(directory):
+		os.makedirs(directory)
+	os.rename(path, os.path.join(directory, os.path.basename(path)))
+
+# Check the files of the metalink.Metalink m in dl_dir, using a pool of
+# jobs processes (default: one per CPU), which hash at most disk_jobs
+# files of one device at a time. aliases maps file names to other names
+# of the same file. Returns the list of bad files.
+def verify(m, dl_dir, check_hashes = True, jobs = None, aliases = {}, disk_jobs = 1):
+	import multiprocessing
+
+	old_dir = os.path.join(dl_dir, 'old', time.strftime('%Y-%m-%d'))
+	bad_dir = os.path.join(old_dir, 'bad')
+	unknown_dir = os.path.join(old_dir, 'unknown')
+
+	saw_file = set()
+	tasks = []
+	for f in m.files:
+		filename = os.path.basename(f.filename)
+		saw_file.add(filename)
+		saw_file.update(aliases.get(filename, []))
+		for res in f.resources:
+			if res.type == 'bittorrent':
+				saw_file.add(res.url.split("?")[0].split("/")[-1])
+
+		path = os.path.join(dl_dir, filename)
+		if os.path.exists(path):
+			tasks.append((os.stat(path).st_dev, (filename, path, f.size, f.hashes['md5'], check_hashes)))
+
+	bad = []
+	pool = multiprocessing.Pool(jobs)
+	try:
+		for filename, result in imap_by_device(pool, check_file, tasks, disk_jobs):
+			if result != 'OK':
+				bad.append(filename)
+				if not os.path.exists(bad_dir):
+					os.makedirs(bad_dir)
+				with open(os.path.join(bad_dir, 'descript.ion'), 'ab') as f:
+					f.write('%s %s\n' % (filename.encode('utf-8'), result))
+				move(os.path.join(dl_dir, filename), bad_dir)
+			print(filename)
+			print(' >> ' + result)
+	finally:
+		pool.terminate()
+
+	# List the directory as unicode, like the names from the metalink
+	for filename in sorted(os.listdir(dl_dir.decode(sys.getfilesystemencoding()))):
+		path = os.path.join(dl_dir, filename)
+		if os.path.isfile(path) and os.path.splitext(filename)[1] not in ignored_extensions and filename not in saw_file:
+			print(filename)
+			print(' >> Not in metalink')
+			move(path, unknown_dir)
+
+	for filename in sorted(saw_file):
+		if not os.path.exists(os.path.join(dl_dir, filename)) and not filename.endswith('.torrent'):
+			print(filename)
+			print(' >> Not on disk')
+
+	return bad